@@ -11,138 +11,1124 @@ import asyncio
 import difflib
 import html
 import ast
+import json
+import os
+import time
+import hashlib
+import contextlib
+import codecs
+import tokenize
+import random
+import email.utils
+from collections import Counter, OrderedDict, deque
+from telethon import events
+from telethon.tl.types import PeerChannel
+from telethon.utils import resolve_id
 from .. import loader, utils
 
-@loader.tds
-class AiGenMod(loader.Module):
-    """🤖 Генератор и фиксатор модулей через OnlySq API v2 с защитой от перезаписи команд"""
-    strings = {"name": "AiGen"}
 
-    def __init__(self):
-        self.config = loader.ModuleConfig(
-            loader.ConfigValue("API_KEY", "openai", "🔑 API ключ OnlySq (или 'openai' для публичного доступа)"),
-            loader.ConfigValue("CURRENT_MODEL", "gpt-5", "🧠 Модель по умолчанию"),
-            loader.ConfigValue("MAX_TOKENS", 8000, "Максимум токенов для ответа")
-        )
-        self._models_cache = []
-        self._models_per_page = 6
+class ResponseCache:
+    """Кэш ответов API: LRU в памяти + файлы на диске с TTL и лимитом размера"""
 
-    async def client_ready(self, client, db):
-        self.client = client
+    def __init__(self, path: str, memory_items: int = 32):
+        self.path = path
+        self.memory_items = memory_items
+        self._memory = OrderedDict()  # key -> (ts, content)
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
 
-    async def genmodcmd(self, message):
-        """<описание> — Сгенерировать модуль по описанию. Можно прикрепить файл к команде — он будет учтён после промпта"""
-        args = utils.get_args_raw(message)
-        if not args:
-            return await utils.answer(message, "<b>❌ Введите описание модуля!</b>")
+    @staticmethod
+    def make_key(model, system_prompt, user_prompt, max_tokens) -> str:
+        raw = json.dumps([str(model), system_prompt, user_prompt, int(max_tokens)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-        status = await utils.answer(message, f"<b>🧠 Думаю ({self.config['CURRENT_MODEL']})...</b>")
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
 
-        attached_text = await self._read_attached_text_from_message(message)
-
-        sys_prompt = (
-            "You are the Lead Architect of the Hikka Userbot Framework (Python 3.10+ & Telethon). "
-            "Your task is to generate PRODUCTION-READY, ERROR-FREE Python code for a userbot module based on the user's request.\n\n"
-            "⛔️ CRITICAL OUTPUT RULES:\n"
-            "1. RETURN ONLY RAW CODE. NO Markdown code fences, no extra text.\n"
-            "2. Ensure imports start with: from .. import loader, utils\n"
-            "3. Forbid overwriting core commands: help, ping, info, id, dl, exec, eval, term, sh, restart, update, alias, modules, load, unload.\n"
-            "4. Use async def and await.\n\n"
-            "ARCHITECTURE:\n"
-            "- Class must inherit from loader.Module, decorated with @loader.tds.\n"
-            "- strings = {'name': 'ModuleName'} (+ strings_ru recommended).\n"
-            "- If settings are needed, use loader.ModuleConfig and loader.ConfigValue.\n"
-            "- Use self.db.get/set for persistence.\n"
-            "- Commands: methods ending with 'cmd'.\n"
-            "- Interactions via utils.get_args_raw(message), utils.answer(message, ...).\n"
-            "- Inline via self.inline.form if necessary.\n\n"
-            "Return only final code. No commentary."
-        )
+    def _remember(self, key, ts, content):
+        self._memory[key] = (ts, content)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
 
-        user_prompt = f"REQUEST: {args}"
-        if attached_text:
-            user_prompt += f"\n\nCONTEXT_FILE (Use this logic/text if relevant):\n{attached_text}"
+    def _read_disk(self, key, ttl):
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("ts", 0) > ttl:
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+            return None
+        return entry.get("ts", 0), entry.get("content")
+
+    def _write_disk(self, key, ts, content, max_bytes):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(key), "w", encoding="utf-8") as f:
+            json.dump({"ts": ts, "content": content}, f, ensure_ascii=False)
+        # Вытесняем самые старые файлы, пока кэш не влезет в лимит
+        files = []
+        for name in os.listdir(self.path):
+            full = os.path.join(self.path, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, full))
+        total = sum(size for _, size, _ in files)
+        for _, size, full in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(full)
+                total -= size
+            except OSError:
+                pass
+
+    async def get(self, key: str, ttl: float):
+        entry = self._memory.get(key)
+        if entry and time.time() - entry[0] <= ttl:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return entry[1]
+        self._memory.pop(key, None)
+        entry = await utils.run_sync(self._read_disk, key, ttl)
+        if entry and entry[1]:
+            self._remember(key, *entry)
+            self.stats["disk_hits"] += 1
+            return entry[1]
+        self.stats["misses"] += 1
+        return None
 
-        code = await self._api_request(sys_prompt, user_prompt)
+    async def put(self, key: str, content: str, max_bytes: int):
+        ts = time.time()
+        self._remember(key, ts, content)
+        try:
+            await utils.run_sync(self._write_disk, key, ts, content, max_bytes)
+        except OSError:
+            pass
 
-        code = self._strip_code_fences(code).strip()
+    def clear(self):
+        self._memory.clear()
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+class JobQueue:
+    """Очередь запросов к API: не больше limit одновременно, чаты обслуживаются по кругу"""
+
+    class Job:
+        __slots__ = ("chat_id", "keys", "factory", "on_position", "position", "task", "done")
+
+        def __init__(self, chat_id, keys, factory, on_position):
+            self.chat_id = chat_id
+            self.keys = set(keys)  # (chat_id, id) сообщений (команда, статус), по которым задачу можно отменить
+            self.factory = factory
+            self.on_position = on_position
+            self.position = None  # последняя показанная позиция в очереди
+            self.task = None
+            self.done = asyncio.get_event_loop().create_future()
+
+    def __init__(self, limit):
+        self._limit = limit  # callable -> максимум одновременных запросов
+        self._waiting = OrderedDict()  # chat_id -> deque[Job], порядок = очередь обхода чатов
+        self._running = set()
+
+    def _order(self):
+        # Порядок запуска ожидающих задач при обходе чатов по кругу
+        queues = [list(q) for q in self._waiting.values()]
+        order = []
+        depth = 0
+        while any(depth < len(q) for q in queues):
+            order.extend(q[depth] for q in queues if depth < len(q))
+            depth += 1
+        return order
+
+    def _notify_positions(self):
+        for position, job in enumerate(self._order(), 1):
+            if job.on_position and job.position != position:
+                job.position = position
+                asyncio.ensure_future(job.on_position(position))
+
+    def _dispatch(self):
+        started = False
+        while self._waiting and len(self._running) < max(1, self._limit()):
+            # Следующим обслуживается чат с наименьшим числом запущенных задач,
+            # при равенстве — первый по кругу
+            busy = {}
+            for running in self._running:
+                busy[running.chat_id] = busy.get(running.chat_id, 0) + 1
+            chat_id = min(self._waiting, key=lambda chat: busy.get(chat, 0))
+            queue = self._waiting[chat_id]
+            job = queue.popleft()
+            del self._waiting[chat_id]
+            if queue:
+                self._waiting[chat_id] = queue  # чат уходит в конец круга
+            job.task = asyncio.ensure_future(job.factory())
+            job.task.add_done_callback(lambda task, job=job: self._finish(job, task))
+            self._running.add(job)
+            started = True
+        return started
+
+    def _finish(self, job, task):
+        self._running.discard(job)
+        if not job.done.done():
+            if task.cancelled():
+                job.done.set_result(None)
+            elif task.exception():
+                job.done.set_exception(task.exception())
+            else:
+                job.done.set_result(task.result())
+        if self._dispatch():
+            self._notify_positions()
+
+    async def run(self, chat_id, keys, factory, on_position=None):
+        """Ставит factory() в очередь и ждёт результата. None — задачу отменили."""
+        job = self.Job(chat_id, keys, factory, on_position)
+        self._waiting.setdefault(chat_id, deque()).append(job)
+        self._dispatch()
+        if job.task is None:
+            self._notify_positions()
+        return await job.done
+
+    @staticmethod
+    def _same_peer(key_peer, peer) -> bool:
+        # peer=None: Telegram не сообщил чат (личка, обычная группа) — у них общая нумерация
+        # сообщений аккаунта, поэтому подходят любые задачи, кроме задач из каналов
+        if peer is not None:
+            return key_peer == peer
+        return key_peer is not None and resolve_id(key_peer)[1] is not PeerChannel
+
+    def cancel(self, chat_id=None, message_ids=None, peer=None) -> int:
+        """
+        Отменяет задачи по id сообщений из чата peer (или последнюю задачу чата, если id не заданы).
+        chat_id=None — искать во всех чатах очереди. Возвращает число отменённых задач.
+        """
+        jobs = [job for job in self._running] + [job for q in self._waiting.values() for job in q]
+        if chat_id is not None:
+            jobs = [job for job in jobs if job.chat_id == chat_id]
+        if message_ids is not None:
+            ids = set(message_ids)
+            jobs = [
+                job for job in jobs
+                if any(mid in ids and self._same_peer(key_peer, peer) for key_peer, mid in job.keys)
+            ]
+        elif jobs:
+            jobs = [jobs[-1]]
+        for job in jobs:
+            if job.task is not None:
+                job.task.cancel()
+            else:
+                queue = self._waiting.get(job.chat_id)
+                if queue is not None:
+                    queue.remove(job)
+                    if not queue:
+                        del self._waiting[job.chat_id]
+                job.done.set_result(None)
+        if jobs:
+            self._notify_positions()
+        return len(jobs)
+
+    def cancel_all(self):
+        for job in list(self._running):
+            job.task.cancel()
+        for queue in self._waiting.values():
+            for job in queue:
+                job.done.set_result(None)
+        self._waiting.clear()
+
+
+class LatencyStats:
+    """Скользящие окна задержек по этапам (и моделям) с перцентилями p50/p90/p99"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples = OrderedDict()  # (этап, модель) -> deque последних задержек, с
+
+    def add(self, stage: str, seconds: float, model=None):
+        key = (stage, str(model) if model else "")
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, model=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, time.monotonic() - start, model)
+
+    @staticmethod
+    def percentile(ordered, q: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(len(ordered) * q) - 1))]
+
+    def summary(self):
+        rows = []
+        for (stage, model), samples in self._samples.items():
+            ordered = sorted(samples)
+            rows.append({
+                "stage": stage,
+                "model": model,
+                "count": len(ordered),
+                "p50": self.percentile(ordered, 0.5),
+                "p90": self.percentile(ordered, 0.9),
+                "p99": self.percentile(ordered, 0.99),
+            })
+        return rows
 
-        if code.startswith("ERROR:"):
-            return await utils.answer(status, f"<b>❌ Ошибка API:</b>\n{code}")
+    def clear(self):
+        self._samples.clear()
 
-        file = io.BytesIO(code.encode("utf-8"))
-        file.name = f"mod_{utils.rand(4)}.py"
-        
-        await self.client.send_file(
-            message.chat_id,
-            file,
-            caption=f"<b>✅ Модуль готов!</b>\n🧩 Модель: <code>{html.escape(str(self.config['CURRENT_MODEL']))}</code>",
-            reply_to=message.id
-        )
-        await status.delete()
 
-    async def fixmodcmd(self, message):
-        """<описание> (реплай на .py) — Исправить модуль. Можно прикрепить файл к команде: сначала читается промпт, затем файл, затем код плагина из реплая"""
-        reply = await message.get_reply_message()
-        args = utils.get_args_raw(message) or "Fix syntax and logic errors"
+class ApiError(Exception):
+    """Ошибка запроса к API. retryable — стоит ли повторять, counts — считать ли её сбоем сервера"""
 
-        if not reply:
-            return await utils.answer(message, "<b>❌ Сделай реплай на файл .py.</b>")
+    def __init__(self, message, retryable=False, retry_after=None, counts=True):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.counts = counts
 
-        status = await utils.answer(message, "<b>🧩 Анализирую код...</b>")
 
-        code_content = None
-        if getattr(reply, "document", None):
-            try:
-                file_bytes = await self.client.download_media(reply, bytes)
-                code_content = file_bytes.decode("utf-8", errors="ignore")
-            except Exception as e:
-                return await utils.answer(status, f"<b>Ошибка чтения файла:</b> {e}")
-        else:
-            code_content = reply.raw_text
+class CircuitBreaker:
+    """После threshold сбоев подряд запросы cooldown секунд отклоняются сразу, затем пропускается пробный"""
 
-        if not code_content:
-            return await utils.answer(status, "<b>❌ Не удалось прочитать код.</b>")
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0.0
+
+    def check(self):
+        remaining = self.opened_until - time.monotonic()
+        if remaining > 0:
+            raise ApiError(f"API временно недоступен, повтор через {math.ceil(remaining)} с", counts=False)
+
+    def success(self):
+        self.failures = 0
+        self.opened_until = 0.0
+
+    def failure(self):
+        # Счётчик не сбрасывается при размыкании: если пробный запрос тоже упал — снова ждём cooldown
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_until = time.monotonic() + self.cooldown
+
+
+class RetryPolicy:
+    """Повтор временных ошибок с экспоненциальной задержкой и случайным разбросом (full jitter)"""
+
+    RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
 
-        attached_text = await self._read_attached_text_from_message(message)
-
-        sys_prompt = (
-            "You are a Senior Python Debugger for the Hikka Userbot framework. "
-            "Your task is to fix bugs, optimize performance, and ensure the code follows Hikka architecture.\n"
-            "RULES:\n"
-            "1. Return ONLY raw Python code. No Markdown.\n"
-            "2. Ensure imports are correct (`from .. import loader, utils`).\n"
-            "3. Check for command name conflicts (do not use 'help', 'exec', etc.).\n"
-            "4. Fix indentation and syntax errors.\n"
-            "5. If the user requests new features, add them while maintaining existing logic."
+    def __init__(self, retries, base_delay: float = 1.0, max_delay: float = 30.0):
+        self._retries = retries  # callable -> сколько раз повторять после первой попытки
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def parse_retry_after(value):
+        # Retry-After бывает числом секунд или HTTP-датой
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def error_for_status(self, status, headers, text) -> ApiError:
+        retryable = status in self.RETRY_STATUSES
+        return ApiError(
+            f"HTTP {status}\n{text}",
+            retryable=retryable,
+            retry_after=self.parse_retry_after(headers.get("Retry-After")) if retryable else None,
+            counts=retryable,  # 4xx — ошибка запроса, а не сервера
         )
-        
-        user_prompt_parts = [f"USER_REQUEST: {args}"]
-        if attached_text:
-            user_prompt_parts.append(f"REFERENCE_FILE:\n{attached_text}")
-        user_prompt_parts.append(f"BROKEN_CODE:\n{code_content}")
-        user_prompt = "\n\n".join(user_prompt_parts)
 
-        fixed_code = await self._api_request(sys_prompt, user_prompt)
-        
-        fixed_code = self._strip_code_fences(fixed_code).strip()
+    @staticmethod
+    def error_for_exception(e) -> ApiError:
+        # Обрыв соединения повторяем; таймаут — нет, он и так съел всё время запроса
+        return ApiError(f"{type(e).__name__}: {e}", retryable=isinstance(e, aiohttp.ClientConnectionError))
+
+    def backoff(self, attempt: int, retry_after=None):
+        if retry_after is not None:
+            # Слишком долгий Retry-After не ждём — пользователю проще повторить самому
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(self, breaker: CircuitBreaker, func):
+        retries = max(0, int(self._retries()))
+        for attempt in range(retries + 1):
+            breaker.check()
+            try:
+                result = await func()
+            except ApiError as e:
+                if e.counts:
+                    breaker.failure()
+                delay = self.backoff(attempt, e.retry_after) if e.retryable else None
+                if delay is None or attempt == retries:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            breaker.success()
+            return result
 
-        if fixed_code.startswith("ERROR:"):
-            return await utils.answer(status, f"<b>❌ Ошибка API:</b>\n{fixed_code}")
 
-        file = io.BytesIO(fixed_code.encode("utf-8"))
-        file.name = "fixed_module.py"
+class ModelIndex:
+    """Индекс каталога моделей: поиск по id, готовые HTML-строки и страницы для меню .models"""
 
-        changelog = self._build_changelog(code_content, fixed_code)
-        caption = "<b>✅ Исправлено!</b>"
-        if changelog:
-            caption += f"\n\n<b>Changelog</b>:\n<blockquote><span class=\"tg-spoiler\">{changelog}</span></blockquote>"
+    DESC_LIMIT = 140
+    FILTER_CACHE = 32
 
-        await self.client.send_file(message.chat_id, file, caption=caption, reply_to=message.id)
-        await status.delete()
+    def __init__(self, models, per_page: int):
+        self.models = models
+        self.per_page = per_page
+        self.by_id = {m["id"]: m for m in models}
+        # Экранирование и обрезка делаются один раз, а не на каждое нажатие кнопки
+        self._lines = {}
+        self._search = {}
+        for m in models:
+            desc = m.get("description") or ""
+            if len(desc) > self.DESC_LIMIT:
+                desc = desc[:self.DESC_LIMIT - 3] + "..."
+            line = f" <b>{html.escape(m['name'])}</b>\n<code>{html.escape(m['id'])}</code>\n"
+            if desc:
+                line += f"{html.escape(desc)}\n"
+            self._lines[m["id"]] = line + "\n"
+            self._search[m["id"]] = " ".join((m["id"], m["name"], m.get("description") or "")).lower()
+        self._views = OrderedDict()  # запрос -> список страниц [(ids, текст)]
+
+    @staticmethod
+    def _cost_matches(cost, want: str) -> bool:
+        # Без цены или "free" — бесплатная модель, в сравнениях с N она считается ценой 0
+        if cost is None or str(cost).strip().lower() in ("", "free"):
+            cost = 0.0
+        try:
+            cost = float(cost)
+        except (TypeError, ValueError):
+            cost = None  # Цена в непонятном формате: не бесплатная, но и сравнить не с чем
+        free = cost is not None and cost <= 0
+        if want == "free":
+            return free
+        if want == "paid":
+            return not free
+        m = re.fullmatch(r"(<=|<|>=|>)?\s*(\d+(?:\.\d+)?)", want)
+        if not m or cost is None:
+            return False
+        op, value = m.group(1) or "<=", float(m.group(2))
+        return {"<=": cost <= value, "<": cost < value, ">=": cost >= value, ">": cost > value}[op]
+
+    def _filter(self, query: str):
+        # owner:<имя> modality:<тип> cost:free|paid|<=N, остальные слова ищутся в id, имени и описании
+        words, fields = [], {}
+        for token in query.lower().split():
+            key, sep, value = token.partition(":")
+            if sep and key in ("owner", "modality", "cost") and value:
+                fields[key] = value
+            else:
+                words.append(token)
+        result = []
+        for m in self.models:
+            if "owner" in fields and fields["owner"] not in m.get("owner", "").lower():
+                continue
+            if "modality" in fields and fields["modality"] not in m.get("modality", "").lower():
+                continue
+            if "cost" in fields and not self._cost_matches(m.get("cost"), fields["cost"]):
+                continue
+            blob = self._search[m["id"]]
+            if all(w in blob for w in words):
+                result.append(m["id"])
+        return result
+
+    def pages(self, query: str = ""):
+        query = " ".join(query.split())
+        view = self._views.get(query)
+        if view is None:
+            ids = self._filter(query) if query else [m["id"] for m in self.models]
+            view = []
+            for start in range(0, len(ids), self.per_page):
+                chunk = ids[start:start + self.per_page]
+                view.append((chunk, "".join("▪️" + self._lines[mid] for mid in chunk)))
+            self._views[query] = view
+            while len(self._views) > self.FILTER_CACHE:
+                self._views.popitem(last=False)
+        self._views.move_to_end(query)
+        return view
+
+    def render(self, page_ids, text, current_id):
+        # Готовая страница пересобирается только если на ней текущая модель
+        if current_id not in page_ids:
+            return text
+        return "".join(("✅" if mid == current_id else "▪️") + self._lines[mid] for mid in page_ids)
+
+
+class PromptBudget:
+    """Грубая оценка токенов и ужатие справочных частей промпта под бюджет модели"""
+
+    # Секции, которые ужимаются до этого размера, просто выбрасываются
+    MIN_SECTION_TOKENS = 64
+
+    @staticmethod
+    def estimate(text) -> int:
+        # ~4 байта UTF-8 на токен: латиница ~4 символа, кириллица ~2 символа на токен
+        return (len(str(text or "").encode("utf-8")) + 3) // 4
+
+    @staticmethod
+    def outline(code: str):
+        # Конспект Python-файла: импорты, сигнатуры классов/функций и первые строки докстрингов
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            return None
+        lines = code.splitlines()
+        out = []
+
+        def walk(body, depth):
+            for node in body:
+                if isinstance(node, (ast.Import, ast.ImportFrom)):
+                    out.append(ast.get_source_segment(code, node) or "")
+                elif isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                    for dec in node.decorator_list:
+                        out.append("    " * depth + "@" + (ast.get_source_segment(code, dec) or ""))
+                    header = lines[node.lineno - 1].strip()
+                    out.append("    " * depth + header)
+                    doc = ast.get_docstring(node)
+                    if doc:
+                        out.append("    " * (depth + 1) + '"""' + doc.strip().splitlines()[0] + '"""')
+                    if isinstance(node, ast.ClassDef):
+                        walk(node.body, depth + 1)
+                    else:
+                        out.append("    " * (depth + 1) + "...")
+
+        walk(tree.body, 0)
+        return "\n".join(out)
+
+    @classmethod
+    def shrink(cls, text: str, tokens: int):
+        # Сначала пробуем конспект, затем оставляем начало и конец текста
+        if cls.estimate(text) <= tokens:
+            return text
+        if tokens < cls.MIN_SECTION_TOKENS:
+            return None
+        outline = cls.outline(text)
+        if outline and cls.estimate(outline) <= tokens:
+            return "# [конспект файла: только сигнатуры]\n" + outline
+        keep = max(1, len(text) * tokens // cls.estimate(text) - 64)
+        head, tail = text[:keep * 2 // 3], text[len(text) - keep // 3:]
+        head = head[:head.rfind("\n") + 1] or head
+        tail = tail[tail.find("\n") + 1:] or tail
+        skipped = text.count("\n") - head.count("\n") - tail.count("\n")
+        return f"{head}\n... [пропущено строк: {skipped}] ...\n{tail}"
+
+    @classmethod
+    def fit(cls, sections, budget: int):
+        """sections: [(заголовок, текст, можно_ужать)]. Возвращает (промпт, сколько токенов не влезло)"""
+        parts, overflow = cls.fit_parts(sections, budget)
+        return "\n\n".join(header + text for header, text in parts), overflow
+
+    @classmethod
+    def fit_parts(cls, sections, budget: int):
+        """Как fit, но возвращает ([(заголовок, ужатый текст)], сколько токенов не влезло)"""
+        parts = [[header, text, trimmable] for header, text, trimmable in sections if text]
+        total = sum(cls.estimate(header) + cls.estimate(text) for header, text, _ in parts)
+        for part in parts:
+            if total <= budget:
+                break
+            if not part[2]:
+                continue
+            size = cls.estimate(part[1])
+            shrunk = cls.shrink(part[1], size - (total - budget))
+            total -= size - cls.estimate(shrunk)
+            if shrunk is None:
+                total -= cls.estimate(part[0])
+            part[1] = shrunk
+        return [(header, text) for header, text, _ in parts if text], max(0, total - budget)
+
+    @staticmethod
+    def indent_of(code: str) -> str:
+        for line in code.splitlines():
+            if line.strip():
+                return line[:len(line) - len(line.lstrip())]
+        return ""
+
+    @staticmethod
+    def _string_lines(code: str):
+        """Номера строк (с нуля), которые начинаются внутри строкового литерала; None — код не токенизируется"""
+        try:
+            tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+        except (tokenize.TokenError, SyntaxError):
+            return None
+        inside, fstrings = set(), []
+        for tok in tokens:
+            if tok.type == tokenize.STRING:
+                inside.update(range(tok.start[0], tok.end[0]))
+            elif tok.type == getattr(tokenize, "FSTRING_START", None):
+                fstrings.append(tok.start[0])
+            elif tok.type == getattr(tokenize, "FSTRING_END", None) and fstrings:
+                inside.update(range(fstrings.pop(), tok.end[0]))
+        return inside
+
+    @classmethod
+    def dedent_code(cls, code: str):
+        """
+        Снимает общий отступ со строк кода, не трогая строки внутри многострочных литералов.
+        Код, который не токенизируется, теряет только отступ, общий для всех строк. Возвращает (текст, префикс)
+        """
+        skip = cls._string_lines(code) or set()
+        lines = code.splitlines(keepends=True)
+        indents = [
+            line[:len(line) - len(line.lstrip())]
+            for i, line in enumerate(lines) if i not in skip and line.strip()
+        ]
+        prefix = os.path.commonprefix(indents) if indents else ""
+        if not prefix:
+            return code, ""
+        return "".join(
+            line[len(prefix):] if i not in skip and line.startswith(prefix) else line
+            for i, line in enumerate(lines)
+        ), prefix
+
+    @classmethod
+    def indent_code(cls, code: str, prefix: str, strings: bool = True) -> str:
+        """Обратное к dedent_code: добавляет prefix к непустым строкам (при strings — только вне литералов)"""
+        if not prefix:
+            return code
+        skip = (cls._string_lines(code) or set()) if strings else set()
+        return "".join(
+            prefix + line if i not in skip and line.strip() else line
+            for i, line in enumerate(code.splitlines(keepends=True))
+        )
+
+    @classmethod
+    def reindent(cls, original: str, result: str) -> str:
+        """Возвращает ответу модели отступ, снятый dedent_code с исходного фрагмента"""
+        prefix = cls.dedent_code(original)[1]
+        # Нетокенизируемый фрагмент сдвигался целиком, вместе со строками литералов
+        return cls.indent_code(cls.dedent_code(result)[0], prefix, cls._string_lines(original) is not None)
+
+    @classmethod
+    def stitch(cls, chunks, results) -> str:
+        """Склеивает исправленные куски в исходном порядке, возвращая им отступ и пустые строки между блоками"""
+        stitched = []
+        for chunk, result in zip(chunks, results):
+            fixed = cls.reindent(chunk, result)
+            stitched.append(fixed.rstrip("\n") + "\n" * max(1, len(chunk) - len(chunk.rstrip("\n"))))
+        return "".join(stitched)
+
+    @classmethod
+    def round_trips(cls, code: str, chunks) -> bool:
+        """Проверка разрезания: куски, возвращённые без изменений, должны склеиться в тот же код"""
+        stitched = cls.stitch(chunks, [cls.dedent_code(chunk)[0] for chunk in chunks])
+        try:
+            return ast.dump(ast.parse(stitched)) == ast.dump(ast.parse(code))
+        except SyntaxError:
+            pass
+        try:
+            ast.parse(code)
+            return False  # Исходник парсится, а склейка — нет
+        except SyntaxError:
+            return [l.rstrip() for l in stitched.splitlines()] == [l.rstrip() for l in code.splitlines()]
+
+    @classmethod
+    def split_code(cls, code: str, max_tokens: int):
+        """Режет код на куски не больше max_tokens по границам классов/функций; "".join(куски) == code"""
+        lines = code.splitlines(keepends=True)
+        starts = cls._unit_starts(code, lines, max_tokens)
+        units = ["".join(lines[a:b]) for a, b in zip(starts, starts[1:] + [len(lines)])]
+        chunks, current = [], ""
+        for unit in units:
+            # Блок с меньшим отступом не приклеиваем: у каждого куска первая строка — самая левая
+            if current and (
+                cls.estimate(current + unit) > max_tokens or cls.indent_of(unit) < cls.indent_of(current)
+            ):
+                chunks.append(current)
+                current = ""
+            current += unit
+        if current:
+            chunks.append(current)
+        return chunks
+
+    @classmethod
+    def _unit_starts(cls, code, lines, max_tokens):
+        # Номера строк, с которых начинаются самостоятельные блоки; большие классы делятся по методам
+        def node_start(node):
+            return min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])]) - 1
+
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            tree = None
+        if tree is not None:
+            starts = []
+            nodes = tree.body
+            for i, node in enumerate(nodes):
+                starts.append(node_start(node))
+                end = node_start(nodes[i + 1]) if i + 1 < len(nodes) else len(lines)
+                if isinstance(node, ast.ClassDef) and cls.estimate("".join(lines[starts[-1]:end])) > max_tokens:
+                    starts.extend(node_start(child) for child in node.body[1:])
+        else:
+            # Код не парсится (частый случай для .fixmod) — режем по строкам def/class без отступа или с одним уровнем
+            starts = []
+            for i, line in enumerate(lines):
+                if re.match(r"(?:    )?(?:@|def |async def |class )", line):
+                    prev = lines[i - 1] if i else ""
+                    indent = line[:len(line) - len(line.lstrip())]
+                    if not prev.startswith(indent + "@"):
+                        starts.append(i)
+        starts = sorted(set(s for s in starts if 0 < s < len(lines)))
+        return [0] + starts
+
+
+class PromptBuilder:
+    """
+    Сборка промпта: статичные секции склеиваются один раз в системный промпт, который байт-в-байт
+    совпадает между запросами (провайдер может кэшировать префикс), переменные идут в сообщение пользователя
+    """
+
+    def __init__(self, *static):
+        # static: (заголовок, текст) в порядке вывода; одинаковые тексты попадают один раз
+        parts, seen = [], set()
+        self.static_report = {}
+        for header, text in static:
+            if not text.strip() or text.strip() in seen:
+                continue
+            seen.add(text.strip())
+            parts.append(header + text)
+            label = self.label(header) or "SYSTEM"
+            self.static_report[label] = self.static_report.get(label, 0) + PromptBudget.estimate(header + text)
+        self.system = "\n\n".join(parts)
+
+    @staticmethod
+    def label(header: str) -> str:
+        # "CONTEXT_FILE (Use this ...):\n" -> "CONTEXT_FILE"
+        return header.split(":")[0].split(" (")[0].strip()
+
+    def build(self, sections, budget: int):
+        """sections: [(заголовок, текст, можно_ужать)]. Возвращает (промпт, сколько не влезло, токены по секциям)"""
+        # Один и тот же файл и в реплае, и во вложении идёт один раз — в обязательной секции
+        seen = {(text or "").strip() for _, text, trimmable in sections if not trimmable}
+        unique = []
+        for header, text, trimmable in sections:
+            key = (text or "").strip()
+            if trimmable and key:
+                if key in seen:
+                    continue
+                seen.add(key)
+            unique.append((header, text, trimmable))
+        parts, overflow = PromptBudget.fit_parts(unique, budget)
+        report = dict(self.static_report)
+        for header, text in parts:
+            report[self.label(header)] = PromptBudget.estimate(header + text)
+        return "\n\n".join(header + text for header, text in parts), overflow, report
+
+    @staticmethod
+    def describe(report) -> str:
+        total = sum(report.values())
+        return f"📏 ~{total} ток.: " + " · ".join(f"{name} {tokens}" for name, tokens in report.items())
+
+
+class CodeValidator:
+    """Локальная проверка сгенерированного кода по правилам из системного промпта"""
+
+    FORBIDDEN_COMMANDS = frozenset({
+        "help", "ping", "info", "id", "dl", "exec", "eval", "term", "sh",
+        "restart", "update", "alias", "modules", "load", "unload",
+    })
+    HIKKA_IMPORT = "from .. import loader, utils"
+    # Сколько строк вокруг синтаксической ошибки уходит в запрос на починку
+    WINDOW = 8
+
+    @staticmethod
+    def _base_name(node) -> str:
+        if isinstance(node, ast.Attribute):
+            return f"{getattr(node.value, 'id', '')}.{node.attr}"
+        return getattr(node, "id", "")
+
+    @classmethod
+    def check(cls, code: str, kind: str = "module"):
+        """Возвращает (список проблем, SyntaxError или None). kind: "module" — Hikka, "plugin" — exteraGram"""
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return [f"SyntaxError: {e.msg} (line {e.lineno})"], e
+        classes = [node for node in ast.walk(tree) if isinstance(node, ast.ClassDef)]
+        problems = []
+        if kind == "plugin":
+            if not any(cls._base_name(b).split(".")[-1] == "BasePlugin" for c in classes for b in c.bases):
+                problems.append("No class inheriting from BasePlugin")
+            return problems, None
+
+        imported = set()
+        for node in tree.body:
+            if isinstance(node, ast.ImportFrom) and node.level == 2 and not node.module:
+                imported.update(alias.name for alias in node.names)
+        if not {"loader", "utils"} <= imported:
+            problems.append(f"Missing import: {cls.HIKKA_IMPORT}")
+        modules = [c for c in classes if any(cls._base_name(b) == "loader.Module" for b in c.bases)]
+        if not modules:
+            problems.append("No class inheriting from loader.Module")
+        for c in modules:
+            for node in c.body:
+                if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    continue
+                # Команды объявляются суффиксом cmd или декоратором @loader.command()
+                if node.name.endswith("cmd"):
+                    command = node.name[:-3]
+                elif any(cls._base_name(getattr(d, "func", d)) == "loader.command" for d in node.decorator_list):
+                    command = node.name
+                else:
+                    continue
+                if command.lower() in cls.FORBIDDEN_COMMANDS:
+                    problems.append(f"Forbidden command name: {node.name} (overrides core .{command})")
+        return problems, None
+
+    @classmethod
+    def add_import(cls, code: str) -> str:
+        # Импорт Hikka вставляется после шапки из комментариев (meta developer и т.п.), докстринга модуля и __future__
+        lines = code.splitlines(keepends=True)
+        pos = 0
+        for i, line in enumerate(lines):
+            if line.lstrip().startswith(("#", "from __future__")):
+                pos = i + 1
+            elif line.strip():
+                break
+        try:
+            body = ast.parse(code).body
+        except SyntaxError:
+            body = []
+        for i, node in enumerate(body):
+            docstring = i == 0 and isinstance(node, ast.Expr) and isinstance(getattr(node, "value", None), ast.Constant) \
+                and isinstance(node.value.value, str)
+            if not docstring and not (isinstance(node, ast.ImportFrom) and node.module == "__future__"):
+                break
+            pos = max(pos, node.end_lineno)
+        return "".join(lines[:pos] + [cls.HIKKA_IMPORT + "\n"] + lines[pos:])
+
+    @classmethod
+    def error_window(cls, code: str, error: SyntaxError):
+        """(начало, конец) строк вокруг ошибки; начало сдвигается к строке с наименьшим отступом окна"""
+        lines = code.splitlines(keepends=True)
+        line = max(1, min(error.lineno or 1, len(lines)))
+        start, end = max(0, line - 1 - cls.WINDOW), min(len(lines), line + cls.WINDOW)
+
+        def indent(text):
+            return len(text) - len(text.lstrip())
+
+        while start < line - 1 and not lines[start].strip():
+            start += 1
+        while start > 0 and indent(lines[start]) > min(indent(l) for l in lines[start:end] if l.strip()):
+            start -= 1
+        return start, end
+
+
+class CodePatch:
+    """Патч от модели: блоки SEARCH/REPLACE или unified diff, применяются к коду с нечётким поиском"""
+
+    BLOCK = re.compile(r"<{5,}\s*SEARCH[^\n]*\n(.*?)\n?={5,}[^\n]*\n(.*?)\n?>{5,}\s*REPLACE", re.S)
+    # Минимальная похожесть фрагмента, при которой правка всё ещё применяется
+    FUZZY_RATIO = 0.8
+
+    @classmethod
+    def parse(cls, text: str):
+        """
+        Список (search, replace). Пустой список — модель явно ответила NO_CHANGES.
+        ValueError — правок нет или их не к чему привязать (пустой SEARCH, hunk без контекста)
+        """
+        text = str(text or "")
+        hunks = cls.BLOCK.findall(text)
+        if any(not s.strip() for s, _ in hunks):
+            raise ValueError("блок с пустым SEARCH")
+        if hunks or not re.search(r"^@@", text, re.M):
+            if not hunks and "NO_CHANGES" not in text:
+                raise ValueError("в ответе нет правок")
+            return hunks
+        # Unified diff: контекст идёт в обе части, "-" только в search, "+" только в replace
+        search, replace, inside = [], [], False
+
+        def close_hunk():
+            if search:
+                hunks.append(("\n".join(search), "\n".join(replace)))
+            elif replace:
+                # Только строки "+": без контекста место вставки не найти
+                raise ValueError("hunk без строк контекста")
+
+        for line in text.splitlines():
+            if line.startswith("@@"):
+                close_hunk()
+                search, replace, inside = [], [], True
+            elif not inside or line.startswith(("\\", "```")):
+                continue
+            elif line.startswith("-"):
+                search.append(line[1:])
+            elif line.startswith("+"):
+                replace.append(line[1:])
+            else:
+                search.append(line[1:])
+                replace.append(line[1:])
+        close_hunk()
+        if not hunks and "NO_CHANGES" not in text:
+            raise ValueError("в diff нет правок")
+        return hunks
+
+    @classmethod
+    def _locate(cls, lines, needle):
+        size = len(needle)
+        windows = range(len(lines) - size + 1)
+        # Точное совпадение, затем без учёта отступов
+        for key in (str.rstrip, str.strip):
+            target = [key(l) for l in needle]
+            for i in windows:
+                if key(lines[i]) == target[0] and [key(l) for l in lines[i:i + size]] == target:
+                    return i
+        # Нечёткое: самое похожее окно той же длины
+        text = "\n".join(l.strip() for l in needle)
+        matcher = difflib.SequenceMatcher(None, "", text, autojunk=False)
+        best, best_ratio = None, cls.FUZZY_RATIO
+        for i in windows:
+            matcher.set_seq1("\n".join(l.strip() for l in lines[i:i + size]))
+            if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = i, ratio
+        return best
+
+    @staticmethod
+    def _reindent(new, needle, matched):
+        """
+        Сдвигает строки замены на разницу отступов между найденным фрагментом и SEARCH:
+        если модель ошиблась с отступом в SEARCH, в REPLACE он такой же. Строки внутри литералов не трогаются
+        """
+        src, dst = PromptBudget.indent_of("\n".join(needle)), PromptBudget.indent_of("\n".join(matched))
+        if src == dst:
+            return new
+        skip = PromptBudget._string_lines("\n".join(new) + "\n") or set()
+        out = []
+        for i, line in enumerate(new):
+            if i in skip or not line.strip():
+                out.append(line)
+            elif line.startswith(src):
+                out.append(dst + line[len(src):])
+            elif len(dst) > len(src):
+                out.append(dst[:len(dst) - len(src)] + line)
+            else:
+                body = line.lstrip()
+                out.append(line[:len(line) - len(body)][len(src) - len(dst):] + body)
+        return out
+
+    @classmethod
+    def apply(cls, code: str, hunks):
+        """Возвращает (новый код, [(строка, удалено, добавлено)]). ValueError — правку некуда применить"""
+        lines = code.splitlines()
+        applied = []
+        for search, replace in hunks:
+            needle = search.splitlines()
+            at = cls._locate(lines, needle)
+            if at is None:
+                raise ValueError(f"не найден фрагмент: {needle[0].strip()[:60]}")
+            new = cls._reindent(replace.splitlines(), needle, lines[at:at + len(needle)])
+            lines[at:at + len(needle)] = new
+            applied.append((at + 1, len(needle), len(new)))
+        return "\n".join(lines) + "\n", applied
+
+
+class SymbolTable:
+    """Символы Python-кода по полным именам (Class.method): вид, сигнатура, декораторы и хэш тела"""
+
+    __slots__ = ("symbols", "imports")
+
+    def __init__(self, symbols, imports):
+        self.symbols = symbols  # полное имя -> (вид, сигнатура, декораторы, хэш тела)
+        self.imports = imports
+
+    @staticmethod
+    def _hash(nodes) -> str:
+        # ast.dump без позиций: форматирование и комментарии на хэш не влияют
+        digest = hashlib.sha1()
+        for node in nodes:
+            digest.update(ast.dump(node).encode("utf-8"))
+        return digest.hexdigest()
+
+    @classmethod
+    def extract(cls, code: str):
+        """SymbolTable или None, если код не парсится"""
+        try:
+            tree = ast.parse(code or "")
+        except (SyntaxError, ValueError):
+            return None
+        symbols = {}
+        pending = [("", tree.body)]
+        while pending:
+            prefix, body = pending.pop()
+            for node in body:
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    qual = prefix + node.name
+                    sig = f"{node.name}({ast.unparse(node.args)})"
+                    if node.returns is not None:
+                        sig += f" -> {ast.unparse(node.returns)}"
+                    if isinstance(node, ast.AsyncFunctionDef):
+                        sig = "async " + sig
+                    kind = "command" if node.name.endswith("cmd") else "function"
+                    decorators = tuple(ast.unparse(d) for d in node.decorator_list)
+                    symbols[qual] = (kind, sig, decorators, cls._hash(node.body))
+                    pending.append((qual + ".", node.body))
+                elif isinstance(node, ast.ClassDef):
+                    qual = prefix + node.name
+                    bases = ", ".join(ast.unparse(b) for b in node.bases + node.keywords)
+                    decorators = tuple(ast.unparse(d) for d in node.decorator_list)
+                    # Тело класса без методов: иначе любая правка метода помечала бы весь класс
+                    own = [n for n in node.body if not isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))]
+                    symbols[qual] = ("class", f"{node.name}({bases})", decorators, cls._hash(own))
+                    pending.append((qual + ".", node.body))
+        imports = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                imports.update(
+                    f"import {a.name} as {a.asname}" if a.asname else f"import {a.name}" for a in node.names
+                )
+            elif isinstance(node, ast.ImportFrom):
+                names = ", ".join(f"{a.name} as {a.asname}" if a.asname else a.name for a in node.names)
+                imports.add(f"from {'.' * node.level}{node.module or ''} import {names}")
+        return cls(symbols, imports)
+
+    def diff(self, other: "SymbolTable") -> dict:
+        """Изменения от self к other: added/removed по видам, signature, modified, imports"""
+        old, new = self.symbols, other.symbols
+        result = {
+            "added": sorted(set(new) - set(old)),
+            "removed": sorted(set(old) - set(new)),
+            "signature": [],
+            "modified": [],
+            "added_imports": sorted(other.imports - self.imports),
+            "removed_imports": sorted(self.imports - other.imports),
+        }
+        for name in sorted(set(old) & set(new)):
+            o, n = old[name], new[name]
+            if o[:3] != n[:3]:
+                result["signature"].append((name, o, n))
+            elif o[3] != n[3]:
+                result["modified"].append(name)
+        return result
+
+    @staticmethod
+    def line_stats(old: str, new: str):
+        """(+строк, -строк) за линейное время: мультимножества хэшей строк без поиска выравнивания"""
+        old_count = Counter(hash(line) for line in (old or "").splitlines())
+        new_count = Counter(hash(line) for line in (new or "").splitlines())
+        return sum((new_count - old_count).values()), sum((old_count - new_count).values())
+
+
+@loader.tds
+class AiGenMod(loader.Module):
+    """🤖 Генератор и фиксатор модулей через OnlySq API v2 с защитой от перезаписи команд"""
+    strings = {"name": "AiGen"}
 
-    def _extera_reference_prompt(self, goal: str) -> str:
-        tpl = """Ты — искусственный интеллект-разработчик, специализирующийся на создании плагинов для Telegram-клиента ExteraGram. Используй следующие источники:
+    # Пул соединений к api.onlysq.ru: один на модуль, живёт до on_unload
+    CONNECTION_LIMIT = 8
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+    # Как часто (в секундах) обновлять статус прогрессом потоковой генерации
+    STREAM_PROGRESS_INTERVAL = 3
+    # Сколько сбоев подряд размыкают цепь и на сколько секунд
+    BREAKER_THRESHOLD = 5
+    BREAKER_COOLDOWN = 60
+    # Хеджирование: сколько последних задержек помнить по модели, сколько нужно для p90
+    # и порог (с) до первых замеров
+    LATENCY_HISTORY = 50
+    HEDGE_MIN_SAMPLES = 5
+    HEDGE_DEFAULT_DELAY = 60
+
+    # Системные промпты команд. Статичный текст собирается в PromptBuilder один раз,
+    # чтобы префикс запроса был байт-в-байт одинаковым и кэшировался провайдером
+    GENMOD_PROMPT = (
+        "You are the Lead Architect of the Hikka Userbot Framework (Python 3.10+ & Telethon). "
+        "Your task is to generate PRODUCTION-READY, ERROR-FREE Python code for a userbot module based on the user's request.\n\n"
+        "⛔️ CRITICAL OUTPUT RULES:\n"
+        "1. RETURN ONLY RAW CODE. NO Markdown code fences, no extra text.\n"
+        "2. Ensure imports start with: from .. import loader, utils\n"
+        "3. Forbid overwriting core commands: help, ping, info, id, dl, exec, eval, term, sh, restart, update, alias, modules, load, unload.\n"
+        "4. Use async def and await.\n\n"
+        "ARCHITECTURE:\n"
+        "- Class must inherit from loader.Module, decorated with @loader.tds.\n"
+        "- strings = {'name': 'ModuleName'} (+ strings_ru recommended).\n"
+        "- If settings are needed, use loader.ModuleConfig and loader.ConfigValue.\n"
+        "- Use self.db.get/set for persistence.\n"
+        "- Commands: methods ending with 'cmd'.\n"
+        "- Interactions via utils.get_args_raw(message), utils.answer(message, ...).\n"
+        "- Inline via self.inline.form if necessary.\n\n"
+        "Return only final code. No commentary."
+    )
+    FIXMOD_PROMPT = (
+        "You are a Senior Python Debugger for the Hikka Userbot framework. "
+        "Your task is to fix bugs, optimize performance, and ensure the code follows Hikka architecture.\n"
+        "RULES:\n"
+        "1. Return ONLY raw Python code. No Markdown.\n"
+        "2. Ensure imports are correct (`from .. import loader, utils`).\n"
+        "3. Check for command name conflicts (do not use 'help', 'exec', etc.).\n"
+        "4. Fix indentation and syntax errors.\n"
+        "5. If the user requests new features, add them while maintaining existing logic."
+    )
+    GENPLUG_PROMPT = (
+        "Всегда генерируй рабочий Python-код плагина для exteraGram (.plugin), с корректными импортами, "
+        "из поддерживаемых модулей и без сторонних библиотек. Пользователь получит только этот код — он должен быть полным.\n\n"
+        "ОБЩИЕ ПРАВИЛА ВЫВОДА:\n"
+        "1) Возвращай ТОЛЬКО сырой код одного плагина. Без Markdown, без комментариев до/после кода.\n"
+        "2) Вставляй короткие человеческие комментарии в код (немного), и один намёк: '# сгенерировано в @Username'.\n"
+        "3) Без внешних библиотек. Разрешены стандартные и модули из документаций exteraGram (android_utils, client_utils, markdown_utils, ui.settings, ui.bulletin и т.п.).\n"
+        "4) Если есть сетевые вызовы/тяжёлые задачи — не блокируй UI; используй client_utils.run_on_queue и android_utils.run_on_ui_thread при необходимости.\n"
+        "5) Команды (если ты создаёшь перехват сообщения): регистрируй self.add_on_send_message_hook() в on_plugin_load и обрабатывай в on_send_message_hook с HookResult.\n"
+        "6) Пиши весь код целиком — один класс, который наследуется от BasePlugin.\n\n"
+        "МЕТАДАННЫЕ (обязательны в начале файла, как простые строки):\n"
+        "__id__ = \"<snake_or_kebab_like_id>\"\n"
+        "__name__ = \"<читаемое имя>\"\n"
+        "__description__ = \"<краткое описание>\"\n"
+        "__version__ = \"1.0.0\"\n"
+        "__author__ = \"@Username\"\n"
+        "__min_version__ = \"11.12.0\"\n"
+        "__icon__ = \"sPluginIDE/0\"  # или подходящая из списка\n\n"
+        "СТРУКТУРА:\n"
+        "- Один класс: class SomethingPlugin(BasePlugin):\n"
+        "- on_plugin_load / on_plugin_unload при необходимости.\n"
+        "- create_settings() возвращает список контролов для настроек (если нужны) из ui.settings.\n"
+        "- Если перехватываешь отправку сообщения, возвращай HookResult(strategy=HookStrategy.MODIFY/CANCEL/DEFAULT ...)\n"
+        "- Используй markdown_utils.parse_markdown для форматирования.\n"
+        "- Для уведомлений — ui.bulletin.BulletinHelper.\n"
+        "- Для отправки сообщений — client_utils.send_message.\n\n"
+        "ДОПОЛНИТЕЛЬНО:\n"
+        "- Выбирай подходящую __icon__ из каталога иконок.\n"
+        "- Все команды и тексты локализуй по необходимости кратко, но можно без отдельного словаря.\n"
+        "- Пиши понятный, рабочий код по примерам документаций (Plugin Class, First Plugin, Android/Client/Markdown utils, Dialog Builder, Bulletin Helper).\n"
+        "Верни итоговый плагин полностью."
+    )
+    FIXPLUG_PROMPT = (
+        "Ты Senior Python Debugger для exteraGram (.plugin). "
+        "Задача: исправить, оптимизировать и привести код к рабочему, следуя архитектуре exteraGram.\n\n"
+        "ТРЕБОВАНИЯ К ВЫХОДУ:\n"
+        "1) Верни ТОЛЬКО сырой полный код одного .plugin. Без Markdown и лишнего текста.\n"
+        "2) Корректные импорты из доступных модулей (android_utils, client_utils, markdown_utils, ui.settings, ui.bulletin, и т.д.). Без сторонних библиотек.\n"
+        "3) Сохрани/исправь метаданные вверху файла:\n"
+        "   __id__, __name__, __description__, __version__ (оставь/установи 1.0.0, если нет), __author__ = \"@Username\", __min_version__ = \"11.12.0\", __icon__ подходящая.\n"
+        "4) Один класс-наследник BasePlugin; соблюдай хуки (add_on_send_message_hook и on_send_message_hook) и возвращай HookResult.\n"
+        "5) Исправь синтаксис/отступы, проверь блокирующие вызовы; при сетевых/тяжёлых операциях — используй client_utils.run_on_queue и android_utils.run_on_ui_thread.\n"
+        "6) Комментарии короткие и по делу; один намёк: '# сгенерировано в @Username'.\n"
+        "7) Если пользователь просит новые фичи — добавь, сохранив текущую логику."
+    )
+    PLUGIN_RESOURCES = (
+        "Справочные материалы (для ориентира при необходимости):\n"
+        "- Исходный код Telegram: https://github.com/DrKLO/Telegram\n"
+        "- SDK Telegram Passport (JavaScript): https://core.telegram.org/passport/sdk-javascript"
+    )
+    EXTERA_REFERENCE = """Ты — искусственный интеллект-разработчик, специализирующийся на создании плагинов для Telegram-клиента ExteraGram. Используй следующие источники:
 
 1. Документация ExteraGram:
    - Setup: https://plugins.exteragram.app/docs/setup  
@@ -230,142 +1216,277 @@ return HookResult.DEFAULT
 Теперь сформируй полный код-плагин и структуру, исходя из моей цели: **[твоя конкретная цель здесь]**.
 ---
 
-Ты можешь подставить вместо [твоя конкретная цель здесь] задачу, которую нужно реализовать — и с этим шаблоном запрос к ИИ будет максимально полным, ориентированным на документацию и примеры."""
-        return tpl.replace("[твоя конкретная цель здесь]", str(goal))
+Ты можешь подставить вместо [твоя конкретная цель здесь] задачу, которую нужно реализовать — и с этим шаблоном запрос к ИИ будет максимально полным, ориентированным на документацию и примеры.""".replace("[твоя конкретная цель здесь]", "цель из USER_REQUEST")
+
+    def __init__(self):
+        self.config = loader.ModuleConfig(
+            loader.ConfigValue("API_KEY", "openai", "🔑 API ключ OnlySq (или 'openai' для публичного доступа)"),
+            loader.ConfigValue("CURRENT_MODEL", "gpt-5", "🧠 Модель по умолчанию"),
+            loader.ConfigValue("MAX_TOKENS", 8000, "Максимум токенов для ответа"),
+            loader.ConfigValue("STREAM", True, "📡 Потоковый ответ с прогрессом в статусе (откат на обычный ответ автоматически)", validator=loader.validators.Boolean()),
+            loader.ConfigValue("CACHE", True, "💾 Кэшировать ответы для одинаковых запросов (обход: --fresh)", validator=loader.validators.Boolean()),
+            loader.ConfigValue("CACHE_TTL_HOURS", 24, "Сколько часов хранить ответ в кэше", validator=loader.validators.Integer(minimum=0)),
+            loader.ConfigValue("CACHE_MAX_MB", 20, "Максимальный размер кэша на диске, МБ", validator=loader.validators.Integer(minimum=0)),
+            loader.ConfigValue("MAX_CONCURRENT", 2, "⏳ Сколько запросов к API выполняется одновременно, остальные ждут в очереди", validator=loader.validators.Integer(minimum=1)),
+            loader.ConfigValue("RETRIES", 3, "🔁 Сколько раз повторять запрос при 429/5xx и обрыве соединения", validator=loader.validators.Integer(minimum=0)),
+            loader.ConfigValue("CONTEXT_TOKENS", 32000, "📏 Размер контекста модели в токенах: справка ужимается, большой код чинится по частям", validator=loader.validators.Integer(minimum=2000)),
+            loader.ConfigValue("PATCH_MODE", False, "🩹 .fixmod просит у модели только правки (SEARCH/REPLACE) вместо всего файла (разово: --patch)", validator=loader.validators.Boolean()),
+            loader.ConfigValue("REPAIR_ROUNDS", 2, "🔧 Сколько раз пытаться починить сгенерированный код, не прошедший проверку", validator=loader.validators.Integer(minimum=0)),
+            loader.ConfigValue("HEDGE", False, "🏁 Если модель долго молчит — дублировать запрос на запасную модель и взять первый ответ", validator=loader.validators.Boolean()),
+            loader.ConfigValue("BACKUP_MODEL", "", "🛟 Запасная модель для хеджирования (пусто — выбрать из каталога)"),
+            loader.ConfigValue("HEDGE_AFTER", 0, "Через сколько секунд без ответа дублировать запрос (0 — по p90 задержки модели)", validator=loader.validators.Integer(minimum=0)),
+            loader.ConfigValue("MAX_FILE_KB", 1024, "📎 Максимальный размер файла из реплая или вложения, КБ", validator=loader.validators.Integer(minimum=1)),
+            loader.ConfigValue("MODELS_TTL_HOURS", 6, "📋 Через сколько часов список моделей обновляется в фоне", validator=loader.validators.Integer(minimum=0))
+        )
+        self._models_cache = []
+        self._models_index = None
+        self._models_ts = 0.0
+        self._models_task = None
+        self._models_per_page = 6
+        self._session = None
+        self._cache = ResponseCache(os.path.join(os.path.expanduser("~"), ".cache", "aigen"))
+        self._jobs = JobQueue(lambda: self.config["MAX_CONCURRENT"])
+        self._retry = RetryPolicy(lambda: self.config["RETRIES"])
+        self._breaker = CircuitBreaker(self.BREAKER_THRESHOLD, self.BREAKER_COOLDOWN)
+        self._latencies = {}  # модель -> deque последних задержек успешных ответов, с
+        self._hedge_stats = {"requests": 0, "fired": 0, "backup_wins": 0, "saved": 0.0}
+        self._trace = LatencyStats()
+        plugin_static = (("", self.PLUGIN_RESOURCES), ("REFERENCE_FILE:\n", self.EXTERA_REFERENCE))
+        self._prompts = {
+            "genmod": PromptBuilder(("", self.GENMOD_PROMPT)),
+            "fixmod": PromptBuilder(("", self.FIXMOD_PROMPT)),
+            "genplug": PromptBuilder(("", self.GENPLUG_PROMPT), *plugin_static),
+            "fixplug": PromptBuilder(("", self.FIXPLUG_PROMPT), *plugin_static),
+        }
+
+    async def client_ready(self, client, db):
+        self.client = client
+        self.db = db
+        saved = self.db.get("AiGen", "models", {})
+        if isinstance(saved, dict) and isinstance(saved.get("models"), list):
+            self._set_models(saved["models"], float(saved.get("ts", 0)))
+        # Удаление команды или статуса отменяет связанный запрос
+        self.client.add_event_handler(self._on_deleted, events.MessageDeleted())
+
+    async def on_unload(self):
+        if getattr(self, "client", None):
+            self.client.remove_event_handler(self._on_deleted, events.MessageDeleted())
+        self._jobs.cancel_all()
+        if self._models_task and not self._models_task.done():
+            self._models_task.cancel()
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сессия создаётся лениво и переиспользуется: keep-alive и кэш DNS
+        # избавляют от нового TCP+TLS рукопожатия на каждый запрос
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.CONNECTION_LIMIT,
+                ttl_dns_cache=self.DNS_CACHE_TTL,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def genmodcmd(self, message):
+        """<описание> [--fresh] — Сгенерировать модуль по описанию. Можно прикрепить файл к команде — он будет учтён после промпта"""
+        args, fresh = self._pop_flag(utils.get_args_raw(message), "--fresh")
+        if not args:
+            return await utils.answer(message, "<b>❌ Введите описание модуля!</b>")
+
+        status = await utils.answer(message, f"<b>🧠 Думаю ({self.config['CURRENT_MODEL']})...</b>")
+
+        with self._trace.timer("download"):
+            attached_text, error = await self._download_text(message)
+        if error:
+            return await utils.answer(status, f"<b>❌ {error}</b>")
+
+        prompt = self._prompts["genmod"]
+        with self._trace.timer("prompt"):
+            user_prompt, _, report = prompt.build(
+                [
+                    ("REQUEST: ", args, False),
+                    ("CONTEXT_FILE (Use this logic/text if relevant):\n", attached_text, True),
+                ],
+                self._input_budget(prompt.system),
+            )
+
+        reply = await self._queued_request(
+            message, status, prompt.system, user_prompt, fresh,
+            note=prompt.describe(report), validator=self._code_validator("module"), with_model=True,
+        )
+        if reply is None:
+            return  # Запрос отменён
+        code, model = reply
+
+        code = self._strip_code_fences(code).strip()
+
+        if code.startswith("ERROR:"):
+            return await utils.answer(status, f"<b>❌ Ошибка API:</b>\n{code}")
+
+        code, problems = await self._validate_and_repair(message, status, code, "module")
+        if code is None:
+            return  # Запрос отменён
+
+        file = io.BytesIO(code.encode("utf-8"))
+        file.name = f"mod_{utils.rand(4)}.py"
+        
+        with self._trace.timer("send_file"):
+            await self.client.send_file(
+                message.chat_id,
+                file,
+                caption=f"<b>✅ Модуль готов!</b>\n🧩 Модель: <code>{html.escape(str(model))}</code>"
+                + self._problems_caption(problems),
+                reply_to=message.id
+            )
+        await status.delete()
+
+    async def fixmodcmd(self, message):
+        """<описание> [--fresh] [--patch] (реплай на .py) — Исправить модуль. Можно прикрепить файл к команде: сначала читается промпт, затем файл, затем код плагина из реплая"""
+        reply = await message.get_reply_message()
+        args, fresh = self._pop_flag(utils.get_args_raw(message), "--fresh")
+        args, patch = self._pop_flag(args, "--patch")
+        args = args or "Fix syntax and logic errors"
+
+        if not reply:
+            return await utils.answer(message, "<b>❌ Сделай реплай на файл .py.</b>")
+
+        status = await utils.answer(message, "<b>🧩 Анализирую код...</b>")
+
+        # Файл из реплая и вложение к команде качаются одновременно
+        with self._trace.timer("download"):
+            (code_content, code_error), (attached_text, attached_error) = await asyncio.gather(
+                self._download_text(reply), self._download_text(message)
+            )
+        if code_error or attached_error:
+            return await utils.answer(status, f"<b>❌ {code_error or attached_error}</b>")
+        if not getattr(reply, "document", None):
+            code_content = reply.raw_text
+
+        if not code_content:
+            return await utils.answer(status, "<b>❌ Не удалось прочитать код.</b>")
+
+        sections = [
+            ("USER_REQUEST: ", args, False),
+            ("REFERENCE_FILE:\n", attached_text, True),
+            ("BROKEN_CODE:\n", code_content, False),
+        ]
+
+        hunks = None
+        if patch or self.config["PATCH_MODE"]:
+            fixed_code, hunks = await self._patch_request(message, status, self._prompts["fixmod"], sections, fresh)
+        else:
+            fixed_code = await self._fix_request(message, status, self._prompts["fixmod"], sections, fresh)
+        if fixed_code is None:
+            return  # Запрос отменён
+        
+        fixed_code = self._strip_code_fences(fixed_code).strip()
+
+        if fixed_code.startswith("ERROR:"):
+            return await utils.answer(status, f"<b>❌ Ошибка API:</b>\n{fixed_code}")
+
+        file = io.BytesIO(fixed_code.encode("utf-8"))
+        file.name = "fixed_module.py"
+
+        with self._trace.timer("changelog"):
+            changelog = self._build_changelog(code_content, fixed_code, hunks)
+        caption = "<b>✅ Исправлено!</b>"
+        if changelog:
+            caption += f"\n\n<b>Changelog</b>:\n<blockquote><span class=\"tg-spoiler\">{changelog}</span></blockquote>"
+
+        with self._trace.timer("send_file"):
+            await self.client.send_file(message.chat_id, file, caption=caption, reply_to=message.id)
+        await status.delete()
 
     async def genplugcmd(self, message):
-        """<описание> — Сгенерировать exteraGram .plugin по описанию. Можно прикрепить файл к команде — он будет учтён после промпта"""
-        args = utils.get_args_raw(message)
+        """<описание> [--fresh] — Сгенерировать exteraGram .plugin по описанию. Можно прикрепить файл к команде — он будет учтён после промпта"""
+        args, fresh = self._pop_flag(utils.get_args_raw(message), "--fresh")
         if not args:
             return await utils.answer(message, "<b>❌ Введите описание плагина для exteraGram!</b>")
 
         status = await utils.answer(message, f"<b>🧠 Генерирую .plugin ({self.config['CURRENT_MODEL']})...</b>")
 
-        attached_text = await self._read_attached_text_from_message(message)
-
-        sys_prompt = (
-            "Всегда генерируй рабочий Python-код плагина для exteraGram (.plugin), с корректными импортами, "
-            "из поддерживаемых модулей и без сторонних библиотек. Пользователь получит только этот код — он должен быть полным.\n\n"
-            "ОБЩИЕ ПРАВИЛА ВЫВОДА:\n"
-            "1) Возвращай ТОЛЬКО сырой код одного плагина. Без Markdown, без комментариев до/после кода.\n"
-            "2) Вставляй короткие человеческие комментарии в код (немного), и один намёк: '# сгенерировано в @Username'.\n"
-            "3) Без внешних библиотек. Разрешены стандартные и модули из документаций exteraGram (android_utils, client_utils, markdown_utils, ui.settings, ui.bulletin и т.п.).\n"
-            "4) Если есть сетевые вызовы/тяжёлые задачи — не блокируй UI; используй client_utils.run_on_queue и android_utils.run_on_ui_thread при необходимости.\n"
-            "5) Команды (если ты создаёшь перехват сообщения): регистрируй self.add_on_send_message_hook() в on_plugin_load и обрабатывай в on_send_message_hook с HookResult.\n"
-            "6) Пиши весь код целиком — один класс, который наследуется от BasePlugin.\n\n"
-            "МЕТАДАННЫЕ (обязательны в начале файла, как простые строки):\n"
-            "__id__ = \"<snake_or_kebab_like_id>\"\n"
-            "__name__ = \"<читаемое имя>\"\n"
-            "__description__ = \"<краткое описание>\"\n"
-            "__version__ = \"1.0.0\"\n"
-            "__author__ = \"@Username\"\n"
-            "__min_version__ = \"11.12.0\"\n"
-            "__icon__ = \"sPluginIDE/0\"  # или подходящая из списка\n\n"
-            "СТРУКТУРА:\n"
-            "- Один класс: class SomethingPlugin(BasePlugin):\n"
-            "- on_plugin_load / on_plugin_unload при необходимости.\n"
-            "- create_settings() возвращает список контролов для настроек (если нужны) из ui.settings.\n"
-            "- Если перехватываешь отправку сообщения, возвращай HookResult(strategy=HookStrategy.MODIFY/CANCEL/DEFAULT ...)\n"
-            "- Используй markdown_utils.parse_markdown для форматирования.\n"
-            "- Для уведомлений — ui.bulletin.BulletinHelper.\n"
-            "- Для отправки сообщений — client_utils.send_message.\n\n"
-            "ДОПОЛНИТЕЛЬНО:\n"
-            "- Выбирай подходящую __icon__ из каталога иконок.\n"
-            "- Все команды и тексты локализуй по необходимости кратко, но можно без отдельного словаря.\n"
-            "- Пиши понятный, рабочий код по примерам документаций (Plugin Class, First Plugin, Android/Client/Markdown utils, Dialog Builder, Bulletin Helper).\n"
-            "Верни итоговый плагин полностью.\n\n"
-            "Справочные материалы (для ориентира при необходимости):\n"
-            "- Исходный код Telegram: https://github.com/DrKLO/Telegram\n"
-            "- SDK Telegram Passport (JavaScript): https://core.telegram.org/passport/sdk-javascript"
-        )
-
-        # Добавляем референсный промпт с подстановкой цели
-        reference_prompt = self._extera_reference_prompt(args)
+        with self._trace.timer("download"):
+            attached_text, error = await self._download_text(message)
+        if error:
+            return await utils.answer(status, f"<b>❌ {error}</b>")
+
+        # Справка по exteraGram и ссылки уже в статичном префиксе, здесь только переменная часть
+        prompt = self._prompts["genplug"]
+        with self._trace.timer("prompt"):
+            user_prompt, _, report = prompt.build(
+                [
+                    ("USER_REQUEST: ", args, False),
+                    ("CONTEXT_FILE (Use this as additional context):\n", attached_text, True),
+                ],
+                self._input_budget(prompt.system),
+            )
 
-        user_prompt_parts = [f"USER_REQUEST: {args}", f"REFERENCE_FILE:\n{reference_prompt}"]
-        if attached_text:
-            user_prompt_parts.append(f"CONTEXT_FILE (Use this as additional context):\n{attached_text}")
-        user_prompt_parts.append(
-            "RESOURCES:\n"
-            "Исходный код Telegram: https://github.com/DrKLO/Telegram\n"
-            "SDK Telegram Passport (JavaScript): https://core.telegram.org/passport/sdk-javascript"
+        reply = await self._queued_request(
+            message, status, prompt.system, user_prompt, fresh,
+            note=prompt.describe(report), validator=self._code_validator("plugin"), with_model=True,
         )
-        user_prompt = "\n\n".join(user_prompt_parts)
-
-        code = await self._api_request(sys_prompt, user_prompt)
+        if reply is None:
+            return  # Запрос отменён
+        code, model = reply
         code = self._strip_code_fences(code).strip()
 
         if code.startswith("ERROR:"):
             return await utils.answer(status, f"<b>❌ Ошибка API:</b>\n{code}")
 
+        code, problems = await self._validate_and_repair(message, status, code, "plugin")
+        if code is None:
+            return  # Запрос отменён
+
         file = io.BytesIO(code.encode("utf-8"))
         file.name = f"plugin_{utils.rand(4)}.plugin"
 
-        await self.client.send_file(
-            message.chat_id,
-            file,
-            caption=f"<b>✅ Плагин создан!</b>\n🧩 Модель: <code>{html.escape(str(self.config['CURRENT_MODEL']))}</code>",
-            reply_to=message.id
-        )
+        with self._trace.timer("send_file"):
+            await self.client.send_file(
+                message.chat_id,
+                file,
+                caption=f"<b>✅ Плагин создан!</b>\n🧩 Модель: <code>{html.escape(str(model))}</code>"
+                + self._problems_caption(problems),
+                reply_to=message.id
+            )
         await status.delete()
 
     async def fixplugcmd(self, message):
-        """<описание> (реплай на .plugin) — Исправить exteraGram .plugin. Можно прикрепить файл контекста к команде"""
+        """<описание> [--fresh] (реплай на .plugin) — Исправить exteraGram .plugin. Можно прикрепить файл контекста к команде"""
         reply = await message.get_reply_message()
-        args = utils.get_args_raw(message) or "Исправь ошибки и доведи до рабочего exteraGram .plugin по документациям"
+        args, fresh = self._pop_flag(utils.get_args_raw(message), "--fresh")
+        args = args or "Исправь ошибки и доведи до рабочего exteraGram .plugin по документациям"
 
         if not reply:
             return await utils.answer(message, "<b>❌ Сделай реплай на .plugin (или вставь код в текст).</b>")
 
         status = await utils.answer(message, "<b>🧩 Анализирую .plugin...</b>")
 
-        code_content = None
-        if getattr(reply, "document", None):
-            try:
-                file_bytes = await self.client.download_media(reply, bytes)
-                code_content = file_bytes.decode("utf-8", errors="ignore")
-            except Exception as e:
-                return await utils.answer(status, f"<b>Ошибка чтения файла:</b> {e}")
-        else:
+        # Файл из реплая и вложение к команде качаются одновременно
+        with self._trace.timer("download"):
+            (code_content, code_error), (attached_text, attached_error) = await asyncio.gather(
+                self._download_text(reply), self._download_text(message)
+            )
+        if code_error or attached_error:
+            return await utils.answer(status, f"<b>❌ {code_error or attached_error}</b>")
+        if not getattr(reply, "document", None):
             code_content = reply.raw_text
 
         if not code_content:
             return await utils.answer(status, "<b>❌ Не удалось прочитать .plugin.</b>")
 
-        attached_text = await self._read_attached_text_from_message(message)
-
-        sys_prompt = (
-            "Ты Senior Python Debugger для exteraGram (.plugin). "
-            "Задача: исправить, оптимизировать и привести код к рабочему, следуя архитектуре exteraGram.\n\n"
-            "ТРЕБОВАНИЯ К ВЫХОДУ:\n"
-            "1) Верни ТОЛЬКО сырой полный код одного .plugin. Без Markdown и лишнего текста.\n"
-            "2) Корректные импорты из доступных модулей (android_utils, client_utils, markdown_utils, ui.settings, ui.bulletin, и т.д.). Без сторонних библиотек.\n"
-            "3) Сохрани/исправь метаданные вверху файла:\n"
-            "   __id__, __name__, __description__, __version__ (оставь/установи 1.0.0, если нет), __author__ = \"@Username\", __min_version__ = \"11.12.0\", __icon__ подходящая.\n"
-            "4) Один класс-наследник BasePlugin; соблюдай хуки (add_on_send_message_hook и on_send_message_hook) и возвращай HookResult.\n"
-            "5) Исправь синтаксис/отступы, проверь блокирующие вызовы; при сетевых/тяжёлых операциях — используй client_utils.run_on_queue и android_utils.run_on_ui_thread.\n"
-            "6) Комментарии короткие и по делу; один намёк: '# сгенерировано в @Username'.\n"
-            "7) Если пользователь просит новые фичи — добавь, сохранив текущую логику.\n\n"
-            "Справочные материалы (для ориентира при необходимости):\n"
-            "- Исходный код Telegram: https://github.com/DrKLO/Telegram\n"
-            "- SDK Telegram Passport (JavaScript): https://core.telegram.org/passport/sdk-javascript"
-        )
-
-        # Добавляем референсный промпт с подстановкой цели
-        reference_prompt = self._extera_reference_prompt(args)
-
-        user_prompt_parts = [f"USER_REQUEST: {args}", f"REFERENCE_FILE:\n{reference_prompt}"]
-        if attached_text:
-            user_prompt_parts.append(f"ADDITIONAL_CONTEXT_FILE:\n{attached_text}")
-        user_prompt_parts.append(f"BROKEN_CODE (.plugin):\n{code_content}")
-        user_prompt_parts.append(
-            "RESOURCES:\n"
-            "Исходный код Telegram: https://github.com/DrKLO/Telegram\n"
-            "SDK Telegram Passport (JavaScript): https://core.telegram.org/passport/sdk-javascript"
-        )
-        user_prompt = "\n\n".join(user_prompt_parts)
+        # Справка по exteraGram и ссылки уже в статичном префиксе, здесь только переменная часть
+        sections = [
+            ("USER_REQUEST: ", args, False),
+            ("ADDITIONAL_CONTEXT_FILE:\n", attached_text, True),
+            ("BROKEN_CODE (.plugin):\n", code_content, False),
+        ]
 
-        fixed_code = await self._api_request(sys_prompt, user_prompt)
+        fixed_code = await self._fix_request(message, status, self._prompts["fixplug"], sections, fresh)
+        if fixed_code is None:
+            return  # Запрос отменён
         fixed_code = self._strip_code_fences(fixed_code).strip()
 
         if fixed_code.startswith("ERROR:"):
@@ -374,24 +1495,130 @@ return HookResult.DEFAULT
         file = io.BytesIO(fixed_code.encode("utf-8"))
         file.name = "fixed_plugin.plugin"
 
-        changelog = self._build_changelog(code_content, fixed_code)
+        with self._trace.timer("changelog"):
+            changelog = self._build_changelog(code_content, fixed_code)
         caption = "<b>✅ Плагин исправлён!</b>"
         if changelog:
             caption += f"\n\n<b>Changelog</b>:\n<blockquote><span class=\"tg-spoiler\">{changelog}</span></blockquote>"
 
-        await self.client.send_file(message.chat_id, file, caption=caption, reply_to=message.id)
+        with self._trace.timer("send_file"):
+            await self.client.send_file(message.chat_id, file, caption=caption, reply_to=message.id)
         await status.delete()
 
+    async def aicachecmd(self, message):
+        """[clear] — Статистика кэша ответов (clear — очистить кэш)"""
+        if utils.get_args_raw(message).strip().lower() == "clear":
+            await utils.run_sync(self._cache.clear)
+            return await utils.answer(message, "<b>🧹 Кэш ответов очищен.</b>")
+        stats = self._cache.stats
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        rate = f"{hits * 100 / total:.0f}%" if total else "—"
+        await utils.answer(
+            message,
+            "<b>💾 Кэш ответов</b>\n"
+            f"Попадания: <code>{hits}</code> (память: {stats['memory_hits']}, диск: {stats['disk_hits']})\n"
+            f"Промахи: <code>{stats['misses']}</code>\n"
+            f"Hit-rate: <code>{rate}</code>",
+        )
+
+    async def aihedgecmd(self, message):
+        """Статистика хеджирования запросов на запасную модель"""
+        stats = self._hedge_stats
+        primary = str(self.config["CURRENT_MODEL"])
+        backup = self._backup_model(primary)
+        fired = f"{stats['fired'] * 100 / stats['requests']:.0f}%" if stats["requests"] else "—"
+        await utils.answer(
+            message,
+            "<b>🏁 Хеджирование</b> " + ("включено" if self.config["HEDGE"] else "выключено") + "\n"
+            f"Запасная модель: <code>{html.escape(backup or '—')}</code>\n"
+            f"Порог: <code>{self._hedge_delay(primary):.0f} с</code>\n"
+            f"Запросов: <code>{stats['requests']}</code>, дублировано: <code>{stats['fired']}</code> ({fired})\n"
+            f"Запасная ответила первой: <code>{stats['backup_wins']}</code>\n"
+            f"Сэкономлено (оценка): <code>{stats['saved']:.0f} с</code>",
+        )
+
+    async def aistatscmd(self, message):
+        """[json|reset] — Задержки по этапам и моделям: p50/p90/p99 (json — выгрузить файлом, reset — сбросить)"""
+        arg = utils.get_args_raw(message).strip().lower()
+        if arg == "reset":
+            self._trace.clear()
+            return await utils.answer(message, "<b>🧹 Статистика задержек сброшена.</b>")
+        rows = self._trace.summary()
+        if arg == "json":
+            payload = {
+                "generated_at": time.time(),
+                "stages": rows,
+                "hedge": dict(self._hedge_stats),
+                "cache": dict(self._cache.stats),
+            }
+            file = io.BytesIO(json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8"))
+            file.name = "aistats.json"
+            return await self.client.send_file(message.chat_id, file, reply_to=message.id)
+        if not rows:
+            return await utils.answer(message, "<b>⏱ Пока нет замеров.</b>")
+
+        def fmt(seconds):
+            return f"{seconds * 1000:.0f} мс" if seconds < 1 else f"{seconds:.1f} с"
+
+        lines = ["<b>⏱ Задержки AiGen</b> (p50 / p90 / p99)"]
+        for row in rows:
+            name = row["stage"] + (f" [{row['model']}]" if row["model"] else "")
+            lines.append(
+                f"<code>{html.escape(name)}</code>: {fmt(row['p50'])} / {fmt(row['p90'])} / {fmt(row['p99'])} (n={row['count']})"
+            )
+        await utils.answer(message, "\n".join(lines))
+
+    async def aicancelcmd(self, message):
+        """[реплай на команду или статус] — Отменить запрос к API (без реплая — последний в этом чате)"""
+        reply = await message.get_reply_message()
+        ids = [reply.id] if reply else None
+        cancelled = self._jobs.cancel(utils.get_chat_id(message), ids, message.chat_id)
+        if not cancelled:
+            return await utils.answer(message, "<b>❌ Нет активных запросов для отмены.</b>")
+        await utils.answer(message, f"<b>🚫 Отменено запросов: {cancelled}</b>")
+
+    async def _on_deleted(self, event):
+        self._jobs.cancel(message_ids=event.deleted_ids, peer=getattr(event, "chat_id", None))
+
     async def modelscmd(self, message):
-        """Меню выбора модели"""
-        await utils.answer(message, "<b>🔄 Загружаю список моделей...</b>")
-        models = await self._fetch_models()
+        """[запрос] — Меню выбора модели. Фильтры: owner:<имя> modality:<тип> cost:free|paid|<=N, остальное ищется в названии"""
+        query = utils.get_args_raw(message) or ""
+        if not self._models_cache:
+            await utils.answer(message, "<b>🔄 Загружаю список моделей...</b>")
+        models = await self._get_models()
         if not models:
             return await utils.answer(message, "<b>❌ Ошибка загрузки списка моделей.</b>")
-        await self._show_models_page(message, 0)
+        await self._show_models_page(message, 0, query)
+
+    def _set_models(self, models, ts):
+        self._models_cache = models
+        self._models_index = ModelIndex(models, self._models_per_page)
+        self._models_ts = ts
+
+    async def _get_models(self):
+        # Сохранённый список отдаём сразу; устаревший обновляется в фоне
+        if not self._models_cache:
+            return await self._refresh_models()
+        ttl = int(self.config["MODELS_TTL_HOURS"]) * 3600
+        if time.time() - self._models_ts > ttl:
+            self._refresh_models_background()
+        return self._models_cache
+
+    def _refresh_models_background(self):
+        if self._models_task is None or self._models_task.done():
+            self._models_task = asyncio.ensure_future(self._fetch_models())
+
+    async def _refresh_models(self):
+        # Одновременные вызовы ждут одну и ту же загрузку
+        self._refresh_models_background()
+        try:
+            return await asyncio.shield(self._models_task)
+        except Exception:
+            return None
 
     async def _fetch_models(self):
-        # Попытка получить список моделей через v2 API с откатом на старый endpoint
+        # v2 и старый endpoint опрашиваются параллельно, побеждает первый валидный ответ
         endpoints = [
             "https://api.onlysq.ru/ai/v2/models",
             "https://api.onlysq.ru/ai/models"
@@ -400,136 +1627,148 @@ return HookResult.DEFAULT
             "Authorization": f"Bearer {self.config['API_KEY']}",
             "Accept": "application/json"
         }
-        for url in endpoints:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers, timeout=30) as resp:
-                        if resp.status != 200:
-                            continue
-                        data = await resp.json(content_type=None)
-                        models = self._normalize_models_response(data)
-                        if models:
-                            # Уникализируем модели по id, сохраняем
-                            uniq = {}
-                            for m in models:
-                                uniq[m["id"]] = m
-                            self._models_cache = list(uniq.values())
-                            return self._models_cache
-            except Exception:
-                continue
+        tasks = [
+            asyncio.ensure_future(self._retry.run(self._breaker, lambda url=url: self._get_json(url, headers)))
+            for url in endpoints
+        ]
+        start = time.monotonic()
+        try:
+            for done in asyncio.as_completed(tasks):
+                try:
+                    data = await done
+                except Exception:
+                    continue
+                with self._trace.timer("models.normalize"):
+                    models = self._normalize_models_response(data)
+                if models:
+                    self._trace.add("models.fetch", time.monotonic() - start)
+                    self._set_models(models, time.time())
+                    if getattr(self, "db", None) is not None:
+                        self.db.set("AiGen", "models", {"ts": self._models_ts, "models": self._models_cache})
+                    return self._models_cache
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # проигравший ответ не нужен, но ошибку считаем обработанной
         return None
 
+    async def _get_json(self, url, headers):
+        session = self._get_session()
+        try:
+            async with session.get(url, headers=headers, timeout=30) as resp:
+                if resp.status != 200:
+                    raise self._retry.error_for_status(resp.status, resp.headers, await resp.text())
+                return await resp.json(content_type=None)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            raise self._retry.error_for_exception(e)
+
     def _normalize_models_response(self, data):
-        models = []
+        # Один проход без рекурсии: вложенные "data" обходятся через очередь,
+        # дубли по id сливаются сразу при добавлении
+        uniq = {}
+        special = {"models", "classified", "data", "api-version"}
 
         def add_model(mid, info):
-            if not isinstance(info, dict):
+            if isinstance(info, str) and mid is None:
+                info = {"id": info}
+            elif not isinstance(info, dict):
                 return
             _mid = mid or info.get("id") or info.get("slug") or info.get("model") or info.get("name")
             if not _mid:
                 return
-            name = info.get("name") or _mid
-            desc = info.get("description") or info.get("about") or ""
             modality = info.get("modality") or info.get("type") or ""
             owner = info.get("owner") or info.get("provider") or ""
-            cost = info.get("cost") or info.get("price")
-            models.append({
+            entry = {
                 "id": str(_mid),
-                "name": str(name),
-                "description": str(desc),
+                "name": str(info.get("name") or _mid),
+                "description": str(info.get("description") or info.get("about") or ""),
                 "modality": str(modality) if modality else "",
                 "owner": str(owner) if owner else "",
-                "cost": cost,
-            })
-
-        def parse(obj):
-            if isinstance(obj, dict):
-                # Direct dict with models mapping id->object
-                if "models" in obj:
-                    m = obj["models"]
-                    if isinstance(m, dict):
-                        for mid, info in m.items():
-                            add_model(mid, info)
-                    elif isinstance(m, list):
-                        for info in m:
-                            if isinstance(info, dict):
-                                add_model(None, info)
-                # Classified buckets
-                if "classified" in obj and isinstance(obj["classified"], dict):
-                    for _, bucket in obj["classified"].items():
-                        if isinstance(bucket, dict):
-                            for mid, info in bucket.items():
-                                add_model(mid, info)
-                        elif isinstance(bucket, list):
-                            for info in bucket:
-                                if isinstance(info, dict):
-                                    add_model(None, info)
-                # Sometimes content is under "data"
-                if "data" in obj:
-                    parse(obj["data"])
-                # If dict looks like id->model entries directly (no special keys)
-                special = {"models", "classified", "data", "api-version"}
-                if all(isinstance(v, dict) for k, v in obj.items() if k not in special) and obj:
-                    for mid, info in obj.items():
-                        if mid in special:
-                            continue
-                        add_model(mid, info)
-            elif isinstance(obj, list):
-                for item in obj:
-                    if isinstance(item, dict):
-                        add_model(None, item)
-                    elif isinstance(item, str):
-                        models.append({"id": item, "name": item, "description": "", "modality": "", "owner": "", "cost": None})
-
-        parse(data)
-
-        # deduplicate by id, prefer entries with description/modality if duplicates
-        uniq = {}
-        for m in models:
-            prev = uniq.get(m["id"])
-            if not prev:
-                uniq[m["id"]] = m
-            else:
-                # prefer richer description
-                if len(m.get("description", "")) > len(prev.get("description", "")):
-                    uniq[m["id"]] = m
+                "cost": info.get("cost") if info.get("cost") is not None else info.get("price"),
+            }
+            prev = uniq.get(entry["id"])
+            if prev is None:
+                uniq[entry["id"]] = entry
+                return
+            # Основой берём запись с более подробным описанием, пустые поля добираем из другой
+            if len(entry["description"]) > len(prev["description"]):
+                prev, entry = entry, prev
+                uniq[prev["id"]] = prev
+            for key in ("modality", "owner"):
+                if not prev[key] and entry[key]:
+                    prev[key] = entry[key]
+            # Цена 0 — настоящее значение (бесплатная модель), заменяем только отсутствующую
+            if prev["cost"] is None and entry["cost"] is not None:
+                prev["cost"] = entry["cost"]
+            # Имя по умолчанию равно id — настоящее имя из другой записи важнее
+            if prev["name"] == prev["id"] and entry["name"] != entry["id"]:
+                prev["name"] = entry["name"]
+
+        def add_all(container):
+            if isinstance(container, dict):
+                for mid, info in container.items():
+                    add_model(mid, info)
+            elif isinstance(container, list):
+                for info in container:
+                    add_model(None, info)
+
+        pending = deque([data])
+        while pending:
+            obj = pending.popleft()
+            if isinstance(obj, list):
+                # Список объектов моделей или просто id
+                add_all(obj)
+                continue
+            if not isinstance(obj, dict):
+                continue
+            if "models" in obj:
+                add_all(obj["models"])
+            if isinstance(obj.get("classified"), dict):
+                for bucket in obj["classified"].values():
+                    add_all(bucket)
+            if "data" in obj:
+                pending.append(obj["data"])
+            # Остальные ключи — это id->модель, если все значения словари
+            rest = [(k, v) for k, v in obj.items() if k not in special]
+            if rest and all(isinstance(v, dict) for _, v in rest):
+                for mid, info in rest:
+                    add_model(mid, info)
         return list(uniq.values())
 
-    async def _show_models_page(self, target, page: int = 0):
-        if not self._models_cache:
-            await self._fetch_models()
-        models = self._models_cache or []
-        total_pages = max(1, math.ceil(len(models) / self._models_per_page))
+    async def _show_models_page(self, target, page: int = 0, query: str = ""):
+        await self._get_models()
+        index = self._models_index or ModelIndex([], self._models_per_page)
+        pages = index.pages(query)
+        total_pages = max(1, len(pages))
         page = max(0, min(page, total_pages - 1))
-        start, end = page * self._models_per_page, (page + 1) * self._models_per_page
-        page_models = models[start:end]
+        page_ids, page_text = pages[page] if pages else ([], "")
 
         current_id = str(self.config["CURRENT_MODEL"])
-        current_name = next((m["name"] for m in models if m["id"] == current_id), None)
+        current = index.by_id.get(current_id)
+        current_name = current["name"] if current else None
 
         header = f"<b>🤖 Доступные модели</b>\n🧠 Текущая: <code>{html.escape(current_id)}</code>"
         if current_name and current_name != current_id:
             header += f" — {html.escape(current_name)}"
+        if query:
+            header += f"\n🔎 Поиск: <code>{html.escape(query)}</code>"
         header += f"\n📄 Стр {page + 1}/{total_pages}\n\n"
 
-        text = header
-        buttons = []
-        for m in page_models:
-            sel = "✅" if m["id"] == current_id else "▪️"
-            desc = m.get("description") or ""
-            if len(desc) > 140:
-                desc = desc[:137] + "..."
-            text += f"{sel} <b>{html.escape(m['name'])}</b>\n<code>{html.escape(m['id'])}</code>\n"
-            if desc:
-                text += f"{html.escape(desc)}\n"
-            text += "\n"
-            buttons.append([{"text": f"Выбрать {m['name']}", "callback": self._set_model_callback, "args": [m["id"], page]}])
+        text = header + index.render(page_ids, page_text, current_id)
+        if not page_ids:
+            text += "<i>Ничего не найдено</i>"
+        buttons = [
+            [{"text": f"Выбрать {index.by_id[mid]['name']}", "callback": self._set_model_callback, "args": [mid, page, query]}]
+            for mid in page_ids
+        ]
 
         nav = []
         if page > 0:
-            nav.append({"text": "◀️", "callback": self._page_callback, "args": [page - 1]})
+            nav.append({"text": "◀️", "callback": self._page_callback, "args": [page - 1, query]})
         if page < total_pages - 1:
-            nav.append({"text": "▶️", "callback": self._page_callback, "args": [page + 1]})
+            nav.append({"text": "▶️", "callback": self._page_callback, "args": [page + 1, query]})
         if nav:
             buttons.append(nav)
         buttons.append([{"text": "❌ Закрыть", "action": "close"}])
@@ -539,26 +1778,364 @@ return HookResult.DEFAULT
         else:
             await self.inline.form(text=text, message=target, reply_markup=buttons)
 
-    async def _page_callback(self, call, page: int):
-        await self._show_models_page(call, page)
+    async def _page_callback(self, call, page: int, query: str = ""):
+        await self._show_models_page(call, page, query)
 
-    async def _set_model_callback(self, call, model_id: str, page: int):
+    async def _set_model_callback(self, call, model_id: str, page: int, query: str = ""):
         self.config["CURRENT_MODEL"] = model_id
         try:
             await call.answer(f"✅ Установлена: {model_id}")
         except Exception:
             pass
-        await self._show_models_page(call, page)
+        await self._show_models_page(call, page, query)
+
+    @staticmethod
+    def _pop_flag(args: str, flag: str):
+        # Вырезает флаг из аргументов команды: ("текст --fresh", "--fresh") -> ("текст", True)
+        pattern = rf"(?:^|\s){re.escape(flag)}(?=\s|$)"
+        if not re.search(pattern, args or ""):
+            return args or "", False
+        return re.sub(pattern, "", args).strip(), True
+
+    async def _queued_request(
+        self, message, status, system_prompt, user_prompt, fresh=False, progress=True, note=None, validator=None,
+        with_model=False,
+    ):
+        # Запрос через общую очередь: показывает позицию в статусе, None — запрос отменён.
+        # with_model=True — вернуть (ответ, модель), которая на самом деле ответила (при хеджировании — запасная)
+        model = html.escape(str(self.config["CURRENT_MODEL"]))
+        queued = started = False
+        submitted = time.monotonic()
+
+        async def on_position(position):
+            nonlocal queued
+            if started or not progress:
+                return
+            queued = True
+            try:
+                await utils.answer(status, f"<b>⏳ В очереди: #{position}</b>\n🧠 Модель: <code>{model}</code>")
+            except Exception:
+                pass
 
-    async def _api_request(self, system_prompt, user_prompt):
+        async def job():
+            nonlocal started
+            started = True
+            self._trace.add("queue", time.monotonic() - submitted)
+            if progress and (queued or note):
+                try:
+                    await utils.answer(status, f"<b>🧠 Думаю ({model})...</b>" + (f"\n{note}" if note else ""))
+                except Exception:
+                    pass
+            result, answered = await self._cached_request(
+                system_prompt, user_prompt, status if progress else None, fresh, validator
+            )
+            return (result, answered) if with_model else result
+
+        keys = {(message.chat_id, message.id), (status.chat_id, status.id)}
+        return await self._jobs.run(utils.get_chat_id(message), keys, job, on_position)
+
+    async def _validate_and_repair(self, message, status, code, kind="module"):
+        """
+        Проверяет код до отправки и чинит найденное точечными запросами без исходного промпта.
+        Возвращает (код, оставшиеся проблемы); код None — запрос отменён.
+        """
+        rounds = int(self.config["REPAIR_ROUNDS"])
+        for round_no in range(rounds + 1):
+            # validate — только локальная проверка, запросы на починку идут отдельным этапом repair
+            with self._trace.timer("validate"):
+                problems, error = CodeValidator.check(code, kind)
+                if kind == "module" and any(p.startswith("Missing import") for p in problems):
+                    # Недостающий импорт дописываем сами, без запроса
+                    code = CodeValidator.add_import(code)
+                    problems, error = CodeValidator.check(code, kind)
+            if not problems or round_no == rounds:
+                return code, problems
+
+            try:
+                await utils.answer(
+                    status,
+                    f"<b>🔧 Исправляю ошибки ({round_no + 1}/{rounds})...</b>\n"
+                    + "\n".join(f"• <code>{html.escape(p)}</code>" for p in problems),
+                )
+            except Exception:
+                pass
+
+            if error is not None:
+                # Синтаксическая ошибка: отправляем только окно строк вокруг неё и вклеиваем ответ обратно
+                start, end = CodeValidator.error_window(code, error)
+                lines = code.splitlines(keepends=True)
+                window = "".join(lines[start:end])
+                sys_prompt = (
+                    "You fix a Python syntax error in a FRAGMENT of a larger file. "
+                    "Return ONLY the corrected fragment: the same lines with the error fixed, raw code, no Markdown. "
+                    "The fragment's common indentation was removed; do not add anything outside it."
+                )
+                user_prompt = (
+                    f"ERROR: {error.msg} (line {error.lineno - start} of the fragment)\n\n"
+                    f"FRAGMENT:\n{PromptBudget.dedent_code(window)[0]}"
+                )
+            else:
+                sys_prompt = (
+                    "You fix a generated Python file so it passes the listed checks. "
+                    "Change only what is needed for these problems. Return ONLY the full corrected code, no Markdown."
+                )
+                user_prompt = "PROBLEMS:\n" + "\n".join(f"- {p}" for p in problems) + f"\n\nCODE:\n{code}"
+
+            with self._trace.timer("repair"):
+                fixed = await self._queued_request(message, status, sys_prompt, user_prompt, progress=False)
+            if fixed is None:
+                return None, problems
+            if fixed.startswith("ERROR:"):
+                return code, problems
+            fixed = self._strip_code_fences(fixed)
+            if error is not None:
+                fixed = PromptBudget.reindent(window, fixed)
+                code = "".join(lines[:start]) + fixed.rstrip("\n") + "\n" + "".join(lines[end:])
+            else:
+                code = fixed.strip()
+        return code, problems
+
+    @staticmethod
+    def _problems_caption(problems) -> str:
+        if not problems:
+            return ""
+        return "\n\n<b>⚠️ Не прошло проверку:</b>\n" + "\n".join(f"• <code>{html.escape(p)}</code>" for p in problems)
+
+    def _input_budget(self, system_prompt: str) -> int:
+        # Сколько токенов остаётся на пользовательский промпт с учётом места под ответ
+        budget = int(self.config["CONTEXT_TOKENS"]) - int(self.config["MAX_TOKENS"]) - PromptBudget.estimate(system_prompt)
+        return max(1000, budget)
+
+    def _chunk_limit(self, budget: int) -> int:
+        # Кусок кода должен влезать и во вход, и в ответ модели целиком
+        return max(500, min(budget * 2 // 3, int(self.config["MAX_TOKENS"]) * 4 // 5))
+
+    async def _patch_request(self, message, status, prompt, sections, fresh=False):
+        """
+        Патч-режим: модель присылает только правки, они применяются локально и проверяются ast.parse.
+        Если патч не применился — откат на обычный запрос всего файла. Возвращает (код, применённые правки).
+        """
+        code = next(text for header, text, _ in sections if header.startswith("BROKEN_CODE"))
+        with self._trace.timer("prompt"):
+            built = prompt.build(sections, self._input_budget(prompt.system))
+        user_prompt, overflow, report = built
+        if not overflow:
+            patch_system = (
+                prompt.system
+                + "\n\nPATCH MODE: do NOT return the whole file. Return ONLY edit blocks in this exact format:\n"
+                "<<<<<<< SEARCH\n<exact existing lines, with indentation>\n=======\n<replacement lines>\n>>>>>>> REPLACE\n"
+                "Copy SEARCH lines verbatim from the code and include 2-3 lines of context so each block is unique. "
+                "Blocks are applied top to bottom. If nothing needs to change, return NO_CHANGES."
+            )
+            reply = await self._queued_request(message, status, patch_system, user_prompt, fresh, note=prompt.describe(report))
+            if reply is None:
+                return None, None
+            if reply.startswith("ERROR:"):
+                return reply, None
+            try:
+                patched, hunks = CodePatch.apply(code, CodePatch.parse(self._strip_code_fences(reply)))
+                ast.parse(patched)
+                return patched, hunks
+            except (ValueError, SyntaxError):
+                pass
+            try:
+                await utils.answer(status, "<b>🩹 Патч не применился, запрашиваю файл целиком...</b>")
+            except Exception:
+                pass
+        return await self._fix_request(message, status, prompt, sections, fresh, built), None
+
+    async def _fix_request(self, message, status, prompt, sections, fresh=False, built=None):
+        """
+        Исправление кода: справка ужимается под бюджет, слишком большой код чинится по частям.
+        built — уже собранный prompt.build(sections, ...) из патч-режима, чтобы не собирать второй раз
+        """
+        system_prompt = prompt.system
+        budget = self._input_budget(system_prompt)
+        code = next(text for header, text, _ in sections if header.startswith("BROKEN_CODE"))
+        if built is None:
+            with self._trace.timer("prompt"):
+                built = prompt.build(sections, budget)
+        user_prompt, overflow, report = built
+        note = prompt.describe(report)
+        if not overflow and PromptBudget.estimate(code) <= self._chunk_limit(budget):
+            return await self._queued_request(message, status, system_prompt, user_prompt, fresh, note=note)
+
+        chunks = PromptBudget.split_code(code, self._chunk_limit(budget))
+        if len(chunks) < 2 or not PromptBudget.round_trips(code, chunks):
+            # Делить не по чему или куски не склеиваются обратно без потерь — отправляем как есть, справка уже ужата
+            return await self._queued_request(message, status, system_prompt, user_prompt, fresh, note=note)
+
+        outline = PromptBudget.shrink(PromptBudget.outline(code) or "", budget // 6) or ""
+        chunk_system = (
+            system_prompt
+            + "\n\nThe code is too large and is sent in FRAGMENTS. Fix ONLY the given fragment and return ONLY it. "
+            "The fragment's common indentation may have been removed; keep the structure, we re-indent it back. "
+            "Do not add imports or code from other fragments."
+        )
+        prompts = []
+        for i, chunk in enumerate(chunks, 1):
+            chunk_sections = [
+                (header, text, trimmable) for header, text, trimmable in sections if not header.startswith("BROKEN_CODE")
+            ]
+            chunk_sections.append(("MODULE_OUTLINE:\n", outline, True))
+            chunk_sections.append((f"FRAGMENT {i}/{len(chunks)}:\n", PromptBudget.dedent_code(chunk)[0], False))
+            prompts.append(PromptBudget.fit(chunk_sections, budget)[0])
+
+        done = 0
+
+        async def fix_chunk(prompt):
+            nonlocal done
+            result = await self._queued_request(message, status, chunk_system, prompt, fresh, progress=False)
+            done += 1
+            if result is None:
+                # Отмена одной части отменяет и остальные
+                self._jobs.cancel(message_ids=[message.id, status.id], peer=message.chat_id)
+            elif not result.startswith("ERROR:"):
+                try:
+                    await utils.answer(status, f"<b>🧩 Большой файл: чиню по частям {done}/{len(chunks)}...</b>")
+                except Exception:
+                    pass
+            return result
+
+        await utils.answer(status, f"<b>🧩 Большой файл: чиню по частям 0/{len(chunks)}...</b>")
+        results = await asyncio.gather(*(fix_chunk(p) for p in prompts))
+        if any(r is None for r in results):
+            return None
+        errors = [r for r in results if r.startswith("ERROR:")]
+        if errors:
+            return errors[0]
+        return PromptBudget.stitch(chunks, [self._strip_code_fences(r) for r in results])
+
+    async def _cached_request(self, system_prompt, user_prompt, status=None, fresh=False, validator=None):
+        # Обёртка над _api_request с кэшем по хэшу (модель, промпты, max tokens); возвращает (ответ, модель)
+        if not self.config["CACHE"]:
+            return await self._hedged_request(system_prompt, user_prompt, status, validator)
+        ttl = self.config["CACHE_TTL_HOURS"] * 3600
+        if not fresh:
+            key = ResponseCache.make_key(self.config["CURRENT_MODEL"], system_prompt, user_prompt, self.config["MAX_TOKENS"])
+            cached = await self._cache.get(key, ttl)
+            if cached:
+                return cached, self.config["CURRENT_MODEL"]
+        result, model = await self._hedged_request(system_prompt, user_prompt, status, validator)
+        if self._valid_response(result) and (validator is None or validator(result)):
+            # Ключ — модель, которая на самом деле ответила (при хеджировании это может быть запасная)
+            key = ResponseCache.make_key(model, system_prompt, user_prompt, self.config["MAX_TOKENS"])
+            await self._cache.put(key, result, self.config["CACHE_MAX_MB"] * 1024 * 1024)
+        return result, model
+
+    def _code_validator(self, kind):
+        """Проверка ответа для хеджирования: код без проблем CodeValidator (недостающий импорт дописывается сам)"""
+        def valid(result):
+            with self._trace.timer("validate"):
+                problems, _ = CodeValidator.check(self._strip_code_fences(result), kind)
+            return not any(not p.startswith("Missing import") for p in problems)
+
+        return valid
+
+    @staticmethod
+    def _p90(samples) -> float:
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, math.ceil(len(ordered) * 0.9) - 1)]
+
+    def _hedge_delay(self, model) -> float:
+        if self.config["HEDGE_AFTER"]:
+            return float(self.config["HEDGE_AFTER"])
+        samples = self._latencies.get(model, ())
+        if len(samples) < self.HEDGE_MIN_SAMPLES:
+            return float(self.HEDGE_DEFAULT_DELAY)
+        return self._p90(samples)
+
+    def _backup_model(self, primary):
+        configured = str(self.config["BACKUP_MODEL"] or "").strip()
+        if configured:
+            return configured if configured != primary else None
+        if not self._models_cache:
+            return None
+        current = self._models_index.by_id.get(primary) if self._models_index else None
+        modality = current["modality"] if current else ""
+        candidates = [
+            m["id"] for m in self._models_cache
+            if m["id"] != primary and (not modality or m.get("modality") == modality)
+        ]
+        # Предпочитаем модель с лучшим замеренным p90, иначе первую подходящую из каталога
+        measured = [c for c in candidates if len(self._latencies.get(c, ())) >= self.HEDGE_MIN_SAMPLES]
+        if measured:
+            return min(measured, key=lambda c: self._p90(self._latencies[c]))
+        return candidates[0] if candidates else None
+
+    @staticmethod
+    def _valid_response(result) -> bool:
+        return bool(result) and not result.startswith("ERROR:")
+
+    async def _timed_request(self, model, system_prompt, user_prompt, status=None):
+        # Запрос к конкретной модели с записью задержки успешного ответа
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        result = await self._api_request(system_prompt, user_prompt, status, model)
+        if self._valid_response(result):
+            self._latencies.setdefault(model, deque(maxlen=self.LATENCY_HISTORY)).append(loop.time() - start)
+        return result
+
+    async def _hedged_request(self, system_prompt, user_prompt, status=None, validator=None):
+        """
+        Запрос к текущей модели; при HEDGE, если она не ответила за порог (или упала),
+        тот же промпт уходит запасной модели. Берётся первый ответ, прошедший validator
+        (без него — первый успешный), второй запрос отменяется. Возвращает (ответ, модель).
+        """
+        primary = str(self.config["CURRENT_MODEL"])
+        backup = self._backup_model(primary) if self.config["HEDGE"] else None
+        if not backup:
+            return await self._timed_request(primary, system_prompt, user_prompt, status), primary
+
+        self._hedge_stats["requests"] += 1
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        delay = self._hedge_delay(primary)
+        tasks = {asyncio.ensure_future(self._timed_request(primary, system_prompt, user_prompt, status)): primary}
+        fired = False
+        first_error = first_rejected = None
+        try:
+            while True:
+                timeout = None if fired else max(0.0, start + delay - loop.time())
+                done, _ = await asyncio.wait(list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    model = tasks.pop(task)
+                    result = task.result()
+                    if self._valid_response(result) and validator is not None and not validator(result):
+                        # Ответ не прошёл проверку — считается проигрышем, но лучше ошибки API
+                        first_rejected = first_rejected or (result, model)
+                    elif self._valid_response(result):
+                        if model == backup:
+                            elapsed = loop.time() - start
+                            self._hedge_stats["backup_wins"] += 1
+                            # Основная модель ещё не ответила — сравниваем с её прошлыми медленными ответами
+                            tail = [x for x in self._latencies.get(primary, ()) if x > elapsed]
+                            if tail:
+                                self._hedge_stats["saved"] += sum(tail) / len(tail) - elapsed
+                        return result, model
+                    else:
+                        first_error = first_error or (result, model)
+                if not fired and (not done or not tasks):
+                    # Порог вышел или основная модель вернула ошибку — подключаем запасную
+                    fired = True
+                    self._hedge_stats["fired"] += 1
+                    tasks[asyncio.ensure_future(self._timed_request(backup, system_prompt, user_prompt))] = backup
+                elif not tasks:
+                    return first_rejected or first_error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _api_request(self, system_prompt, user_prompt, status=None, model=None):
         url = "https://api.onlysq.ru/ai/v2"
+        stream = bool(self.config["STREAM"])
         headers = {
             "Authorization": f"Bearer {self.config['API_KEY']}",
             "Content-Type": "application/json",
-            "Accept": "application/json",
+            "Accept": "text/event-stream, application/json" if stream else "application/json",
         }
         data = {
-            "model": self.config["CURRENT_MODEL"],
+            "model": model or self.config["CURRENT_MODEL"],
             "request": {
                 "messages": [
                     {"role": "system", "content": system_prompt},
@@ -567,39 +2144,101 @@ return HookResult.DEFAULT
                 "max_output_tokens": int(self.config["MAX_TOKENS"]),
             },
         }
+        if stream:
+            data["request"]["stream"] = True
 
-        try:
-            async with aiohttp.ClientSession() as session:
+        model = data["model"]
+
+        async def attempt():
+            session = self._get_session()
+            sent = time.monotonic()
+            try:
                 async with session.post(url, headers=headers, json=data, timeout=300) as resp:
+                    self._trace.add("api.ttfb", time.monotonic() - sent, model)
                     if resp.status != 200:
-                        err_text = await resp.text()
-                        return f"ERROR: HTTP {resp.status}\n{err_text}"
-                    result = await resp.json(content_type=None)
-                    content = None
-                    try:
-                        if isinstance(result, dict):
-                            if "choices" in result and isinstance(result["choices"], list) and result["choices"]:
-                                choice = result["choices"][0]
-                                if isinstance(choice, dict):
-                                    if "message" in choice and isinstance(choice["message"], dict):
-                                        content = choice["message"].get("content")
-                                    if content is None:
-                                        content = choice.get("text") or choice.get("delta", {}).get("content")
-                            if content is None and "message" in result:
-                                msg = result["message"]
-                                if isinstance(msg, dict):
-                                    content = msg.get("content") or msg.get("text")
-                            if content is None:
-                                content = result.get("content") or result.get("result") or result.get("output")
-                    except Exception:
-                        content = None
-                    if not content:
-                        return f"ERROR: Empty response"
-                    return self._clean_code(str(content))
-        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-            return f"ERROR: {type(e).__name__}: {e}"
+                        raise self._retry.error_for_status(resp.status, resp.headers, await resp.text())
+                    if stream and resp.content_type == "text/event-stream":
+                        return await self._read_stream(resp, status, model)
+                    # Сервер не стал стримить — обычный JSON-ответ
+                    body = await resp.read()
+                    with self._trace.timer("api.parse", model):
+                        result = json.loads(body)
+                        return self._extract_content(result)
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                raise self._retry.error_for_exception(e)
+
+        try:
+            with self._trace.timer("api.total", model):
+                content = await self._retry.run(self._breaker, attempt)
+        except ApiError as e:
+            return f"ERROR: {e}"
         except Exception as e:
             return f"ERROR: {e}"
+        if isinstance(content, str) and content.startswith("ERROR:"):
+            return content
+        if not content:
+            return f"ERROR: Empty response"
+        return self._clean_code(str(content))
+
+    def _extract_content(self, result):
+        # Достаёт текст из ответа целиком или из одного SSE-чанка (delta)
+        content = None
+        try:
+            if isinstance(result, dict):
+                if "choices" in result and isinstance(result["choices"], list) and result["choices"]:
+                    choice = result["choices"][0]
+                    if isinstance(choice, dict):
+                        if "message" in choice and isinstance(choice["message"], dict):
+                            content = choice["message"].get("content")
+                        if content is None:
+                            content = choice.get("text") or (choice.get("delta") or {}).get("content")
+                if content is None and "message" in result:
+                    msg = result["message"]
+                    if isinstance(msg, dict):
+                        content = msg.get("content") or msg.get("text")
+                if content is None:
+                    content = result.get("content") or result.get("result") or result.get("output")
+        except Exception:
+            content = None
+        return content
+
+    async def _read_stream(self, resp, status=None, model=None):
+        # Читает SSE построчно; куски копятся в списке и склеиваются один раз в конце
+        parts = []
+        chars = lines = 0
+        loop = asyncio.get_event_loop()
+        last_update = loop.time()
+        async for raw in resp.content:
+            line = raw.decode("utf-8", errors="replace").strip()
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                continue
+            if isinstance(chunk, dict) and chunk.get("error"):
+                return f"ERROR: {chunk['error']}"
+            piece = self._extract_content(chunk)
+            if not piece:
+                continue
+            piece = str(piece)
+            parts.append(piece)
+            chars += len(piece)
+            lines += piece.count("\n")
+            if status is not None and loop.time() - last_update >= self.STREAM_PROGRESS_INTERVAL:
+                last_update = loop.time()
+                try:
+                    await utils.answer(
+                        status,
+                        f"<b>🧠 Генерирую ({html.escape(str(model or self.config['CURRENT_MODEL']))})...</b>\n"
+                        f"📝 {lines} строк · ~{chars // 4} токенов",
+                    )
+                except Exception:
+                    pass
+        return "".join(parts)
 
     def _strip_code_fences(self, text: str) -> str:
         if not isinstance(text, str):
@@ -611,124 +2250,121 @@ return HookResult.DEFAULT
     def _clean_code(self, text):
         return str(text).strip()
 
-    async def _read_attached_text_from_message(self, message):
-        try:
-            if getattr(message, "document", None):
-                file_bytes = await self.client.download_media(message, bytes)
-                if not file_bytes:
-                    return None
-                try:
-                    return file_bytes.decode("utf-8")
-                except Exception:
-                    return file_bytes.decode("utf-8", errors="ignore")
-        except Exception:
-            return None
-        return None
+    # Сколько первых байт файла смотреть, чтобы один раз определить кодировку
+    ENCODING_PROBE = 4096
 
-    def _build_changelog(self, old: str, new: str) -> str:
+    @classmethod
+    def _detect_encoding(cls, head: bytes) -> str:
+        # BOM, затем строгий UTF-8 по началу файла; не UTF-8 — скорее всего cp1251
+        for bom, encoding in ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")):
+            if head.startswith(bom):
+                return encoding
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        except UnicodeDecodeError:
+            return "cp1251"
+        return "utf-8"
+
+    async def _download_text(self, message):
+        """
+        Потоково читает документ сообщения в текст с лимитом MAX_FILE_KB.
+        Возвращает (текст или None, текст ошибки или None); без документа — (None, None).
+        """
+        doc = getattr(message, "document", None)
+        if not doc:
+            return None, None
+        limit = int(self.config["MAX_FILE_KB"]) * 1024
+        too_big = f"Файл больше {self.config['MAX_FILE_KB']} КБ (MAX_FILE_KB)"
+        size = getattr(doc, "size", 0) or 0
+        if size > limit:
+            return None, too_big  # отказ до начала скачивания
+
+        parts = []
+        head = b""
+        received = 0
+        decoder = None
+        try:
+            async for chunk in self.client.iter_download(doc):
+                received += len(chunk)
+                if received > limit:
+                    return None, too_big
+                if decoder is None:
+                    head += chunk
+                    if len(head) < self.ENCODING_PROBE and received < size:
+                        continue
+                    decoder = codecs.getincrementaldecoder(self._detect_encoding(head))(errors="replace")
+                    chunk = head
+                parts.append(decoder.decode(chunk))
+        except Exception as e:
+            return None, f"Ошибка чтения файла: {e}"
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(self._detect_encoding(head))(errors="replace")
+            parts.append(decoder.decode(head))
+        parts.append(decoder.decode(b"", final=True))
+        return "".join(parts) or None, None
+
+    # Для файлов длиннее этого (в строках) правки считаются по хэшам строк, а не difflib
+    CHANGELOG_DIFFLIB_LINES = 3000
+    # Сколько имён показывать в одной строке changelog
+    CHANGELOG_NAMES = 10
+
+    def _build_changelog(self, old: str, new: str, hunks=None) -> str:
         def safe_join(items):
-            return ", ".join(f"<code>{html.escape(x)}</code>" for x in items if x)
-
-        def extract_meta(code: str):
-            meta = {
-                "funcs": set(),
-                "afuncs": set(),
-                "commands": set(),
-                "classes": set(),
-                "imports": set(),
-            }
-            try:
-                tree = ast.parse(code)
-            except Exception:
-                return meta
-
-            class Visitor(ast.NodeVisitor):
-                def visit_FunctionDef(self, node: ast.FunctionDef):
-                    name = node.name
-                    if name.endswith("cmd"):
-                        meta["commands"].add(name)
-                    else:
-                        meta["funcs"].add(name)
-                    self.generic_visit(node)
-
-                def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
-                    name = node.name
-                    if name.endswith("cmd"):
-                        meta["commands"].add(name)
-                    else:
-                        meta["afuncs"].add(name)
-                    self.generic_visit(node)
-
-                def visit_ClassDef(self, node: ast.ClassDef):
-                    meta["classes"].add(node.name)
-                    self.generic_visit(node)
-
-                def visit_Import(self, node: ast.Import):
-                    for alias in node.names:
-                        if alias.asname:
-                            meta["imports"].add(f"import {alias.name} as {alias.asname}")
-                        else:
-                            meta["imports"].add(f"import {alias.name}")
-
-                def visit_ImportFrom(self, node: ast.ImportFrom):
-                    mod = node.module or ""
-                    names = []
-                    for alias in node.names:
-                        if alias.asname:
-                            names.append(f"{alias.name} as {alias.asname}")
-                        else:
-                            names.append(alias.name)
-                    meta["imports"].add(f"from {mod} import {', '.join(names)}")
-
-            Visitor().visit(tree)
-            return meta
+            items = [x for x in items if x]
+            shown = ", ".join(f"<code>{html.escape(x)}</code>" for x in items[:self.CHANGELOG_NAMES])
+            if len(items) > self.CHANGELOG_NAMES:
+                shown += f" и ещё {len(items) - self.CHANGELOG_NAMES}"
+            return shown
 
         try:
-            old_meta = extract_meta(old or "")
-            new_meta = extract_meta(new or "")
-
-            # Sets
-            old_funcs_all = old_meta["funcs"] | old_meta["afuncs"]
-            new_funcs_all = new_meta["funcs"] | new_meta["afuncs"]
-
-            added_cmds = sorted(new_meta["commands"] - old_meta["commands"])
-            removed_cmds = sorted(old_meta["commands"] - new_meta["commands"])
-
-            added_funcs = sorted(new_funcs_all - old_funcs_all - (new_meta["commands"] - old_meta["commands"]))
-            removed_funcs = sorted(old_funcs_all - new_funcs_all - (old_meta["commands"] - new_meta["commands"]))
-
-            added_classes = sorted(new_meta["classes"] - old_meta["classes"])
-            removed_classes = sorted(old_meta["classes"] - new_meta["classes"])
-
-            added_imports = sorted(new_meta["imports"] - old_meta["imports"])
-            removed_imports = sorted(old_meta["imports"] - new_meta["imports"])
-
+            old_table = SymbolTable.extract(old)
+            new_table = SymbolTable.extract(new)
             lines = []
 
-            if added_cmds:
-                lines.append(f"• добавил команды: {safe_join(added_cmds)}")
-            if removed_cmds:
-                lines.append(f"• убрал команды: {safe_join(removed_cmds)}")
-            if added_funcs:
-                lines.append(f"• добавил функции: {safe_join(added_funcs)}")
-            if removed_funcs:
-                lines.append(f"• убрал функции: {safe_join(removed_funcs)}")
-            if added_classes:
-                lines.append(f"• добавил классы: {safe_join(added_classes)}")
-            if removed_classes:
-                lines.append(f"• убрал классы: {safe_join(removed_classes)}")
-            if added_imports:
-                lines.append(f"• добавил импорты: {safe_join(added_imports)}")
-            if removed_imports:
-                lines.append(f"• убрал импорты: {safe_join(removed_imports)}")
+            if old_table is not None and new_table is not None:
+                diff = old_table.diff(new_table)
+
+                def of_kind(names, table, kinds):
+                    return [n for n in names if table.symbols[n][0] in kinds]
+
+                labels = (("command",), "команды"), (("function",), "функции"), (("class",), "классы")
+                for kinds, label in labels:
+                    added = of_kind(diff["added"], new_table, kinds)
+                    removed = of_kind(diff["removed"], old_table, kinds)
+                    if added:
+                        lines.append(f"• добавил {label}: {safe_join(added)}")
+                    if removed:
+                        lines.append(f"• убрал {label}: {safe_join(removed)}")
+                if diff["added_imports"]:
+                    lines.append(f"• добавил импорты: {safe_join(diff['added_imports'])}")
+                if diff["removed_imports"]:
+                    lines.append(f"• убрал импорты: {safe_join(diff['removed_imports'])}")
+                if diff["signature"]:
+                    changes = []
+                    for name, o, n in diff["signature"]:
+                        before = " ".join(f"@{d}" for d in o[2]) + (" " if o[2] else "") + o[1]
+                        after = " ".join(f"@{d}" for d in n[2]) + (" " if n[2] else "") + n[1]
+                        changes.append(f"{name}: {before} → {after}")
+                    lines.append(f"• изменил сигнатуры: {safe_join(changes)}")
+                if diff["modified"]:
+                    lines.append(f"• переписал: {safe_join(diff['modified'])}")
+
+            if hunks:
+                spots = ", ".join(f"стр. {line} (-{removed}/+{added})" for line, removed, added in hunks[:10])
+                if len(hunks) > 10:
+                    spots += ", …"
+                lines.append(f"• применил правки ({len(hunks)}): {spots}")
 
             if not lines:
                 # Если не удалось выделить сущности — кратко показать, что были изменения
                 old_lines = (old or "").splitlines()
                 new_lines = (new or "").splitlines()
-                diff = list(difflib.unified_diff(old_lines, new_lines, lineterm=""))
-                added = sum(1 for ln in diff if ln.startswith("+") and not ln.startswith("+++"))
-                removed = sum(1 for ln in diff if ln.startswith("-") and not ln.startswith("---"))
+                if len(old_lines) + len(new_lines) > self.CHANGELOG_DIFFLIB_LINES:
+                    added, removed = SymbolTable.line_stats(old, new)
+                else:
+                    diff = list(difflib.unified_diff(old_lines, new_lines, lineterm=""))
+                    added = sum(1 for ln in diff if ln.startswith("+") and not ln.startswith("+++"))
+                    removed = sum(1 for ln in diff if ln.startswith("-") and not ln.startswith("---"))
                 if added or removed:
                     lines.append(f"• внёс правки по коду (строк: +{added} / -{removed})")
                 else:
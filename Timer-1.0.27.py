@@ -5,11 +5,21 @@ __version__ = (1, 0, 27)
 # scope: hikka_min 1.2.10
 
 import asyncio
+import heapq
+import itertools
+import logging
+import math
+import random
 import re
+import time
+from collections import deque
+from contextlib import contextmanager
 from telethon.tl.types import Message
 from telethon.errors import FloodWaitError
 from .. import loader, utils
 
+logger = logging.getLogger(__name__)
+
 def _parse_time_string(time_str: str) -> int:
     """
     Парсит строку времени (например, "10s", "5m 30s", "2h 10m", "1d 3h") и возвращает общее количество секунд.
@@ -51,6 +61,342 @@ def _format_seconds_to_hms(seconds: int) -> str:
     minutes, seconds = divmod(remainder, 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
+def _ceil_seconds(remaining: float) -> int:
+    """
+    Округляет остаток вверх до целых секунд, как его показывает обратный отсчёт.
+    Погрешность float в пределах миллисекунды не даёт лишнюю секунду.
+    """
+    return max(0, math.ceil(round(remaining, 3)))
+
+class TimerState:
+    """
+    Состояние одного таймера. deadline/paused_at — моменты loop.time(),
+    остаток вычисляется в remaining() с учётом накопленного времени паузы.
+    """
+
+    __slots__ = (
+        "text", "total_duration", "chat_id", "form_obj", "is_paused",
+        "deadline", "paused_total", "paused_at",
+        "render_fails", "heap_seq", "ticking", "missed_due", "last_render",
+    )
+
+    def __init__(self, text: str, duration: int, chat_id: int, form_obj, is_paused: bool = False):
+        now = asyncio.get_event_loop().time()
+        self.text = text
+        self.total_duration = duration
+        self.chat_id = chat_id
+        self.form_obj = form_obj
+        self.is_paused = is_paused
+        self.deadline = now + duration
+        self.paused_total = 0.0
+        self.paused_at = now if is_paused else None
+        self.render_fails = 0  # Counter for failed renders
+        self.heap_seq = None  # Live heap entry of the scheduler
+        self.ticking = False  # A tick task is in flight
+        self.missed_due = None  # Due popped by the scheduler while a tick was in flight
+        self.last_render = None  # Fingerprint of the last successful edit
+
+    def remaining(self, now=None) -> float:
+        """Остаток таймера в секундах по дедлайну с учётом накопленного времени паузы."""
+        if self.paused_at is not None:
+            now = self.paused_at
+        elif now is None:
+            now = asyncio.get_event_loop().time()
+        return self.deadline + self.paused_total - now
+
+    def pause(self, now: float):
+        """Замораживает остаток."""
+        self.is_paused = True
+        self.paused_at = now
+
+    def resume(self, now: float):
+        """Сдвигает дедлайн на время паузы."""
+        self.is_paused = False
+        self.paused_total += now - self.paused_at
+        self.paused_at = None
+
+    def to_db(self) -> tuple:
+        """
+        Компактный снимок таймера для БД: (text, remaining, chat_id, is_paused, ends_at).
+        Для бегущего таймера ends_at — дедлайн по time.time(), поэтому пока он
+        просто отсчитывает время, перезаписывать его не нужно.
+        """
+        remaining = self.remaining()
+        ends_at = None if self.is_paused else time.time() + remaining
+        return (self.text, _ceil_seconds(remaining), self.chat_id, self.is_paused, ends_at)
+
+    @staticmethod
+    def from_db(data) -> tuple:
+        """
+        Разбирает снимок из БД (в том числе старый 4-элементный формат)
+        в (text, remaining, chat_id, is_paused). Бросает ValueError на мусоре.
+        """
+        if not isinstance(data, (tuple, list)) or len(data) not in (4, 5):
+            raise ValueError(f"data has {len(data) if isinstance(data, (tuple, list)) else 'unknown'} elements, expected 4 or 5")
+        text, remaining, chat_id, is_paused = data[:4]
+        ends_at = data[4] if len(data) == 5 else None
+        if ends_at is not None and not is_paused:
+            # Бегущий таймер сохранён как дедлайн — время простоя тоже засчитывается
+            remaining = _ceil_seconds(ends_at - time.time())
+        return text, remaining, chat_id, bool(is_paused)
+
+class Histogram:
+    """
+    Гистограмма длительностей: count/total/max копятся за всё время,
+    перцентили считаются по окну последних window наблюдений.
+    """
+
+    __slots__ = ("samples", "count", "total", "max")
+
+    def __init__(self, window: int = 256):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Перцентиль q (0..100) по окну методом ближайшего ранга."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+class TimerMetrics:
+    """
+    Метрики модуля: счётчики (рендеры, дедупликация, ошибки, FloodWait)
+    и гистограммы длительностей в секундах. Живут только в памяти.
+    """
+
+    COUNTERS = (
+        "renders", "edits_saved", "dedup_hits", "dedup_misses",
+        "render_fails", "timers_dropped", "flood_waits", "flood_seconds", "db_saves", "ticks",
+        "wakeups",
+    )
+    HISTOGRAMS = ("render", "scheduler_lag", "db_save")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.histograms = {name: Histogram() for name in self.HISTOGRAMS}
+
+    def incr(self, name: str, value=1):
+        self.counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Замеряет длительность блока в гистограмму name (только при успехе)."""
+        started = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - started)
+
+    def flood(self, seconds: float):
+        """Учитывает FloodWait на seconds секунд."""
+        self.counters["flood_waits"] += 1
+        self.counters["flood_seconds"] += seconds
+
+class _MemoryDB(dict):
+    """БД в памяти с интерфейсом db Hikka — для изолированного прогона .timerbench."""
+
+    def get(self, owner, key, default=None):
+        return super().get((owner, key), default)
+
+    def set(self, owner, key, value):
+        self[(owner, key)] = value
+
+class _BenchForm:
+    """Форма-заглушка для .timerbench: edit() медленный, как у Telegram, delete() запоминает момент."""
+
+    def __init__(self, form_id, edit_delay):
+        self.id = form_id
+        self.edit_delay = edit_delay  # (мин, макс) секунд на один edit
+        self.deleted_at = None
+
+    async def edit(self, *args, **kwargs):
+        await asyncio.sleep(random.uniform(*self.edit_delay))
+
+    async def delete(self):
+        self.deleted_at = asyncio.get_event_loop().time()
+
+class TimerStore:
+    """
+    Слой персистентности таймеров: копит изменённые записи в dirty-наборе
+    и сбрасывает их в БД одной записью не чаще раза в interval секунд.
+    """
+
+    def __init__(self, db, interval, metrics=None):
+        self._db = db
+        self._interval = interval  # callable -> секунды между сбросами
+        self._metrics = metrics
+        self._entries = dict(db.get("TimerMod", "active_timers", {}))
+        self._dirty = {}  # {str(form_id): snapshot | None (удаление)}
+        self._flush_handle = None
+
+    def saved(self) -> dict:
+        """Копия сохранённых записей на момент загрузки/последнего сброса."""
+        return dict(self._entries)
+
+    def stage(self, form_id, snapshot):
+        """Помечает запись как изменённую; None означает удаление."""
+        self._dirty[str(form_id)] = snapshot
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                max(0, self._interval()), self.flush
+            )
+
+    def flush(self):
+        """Немедленно пишет все изменённые записи в БД."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        for key, snapshot in self._dirty.items():
+            if snapshot is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = snapshot
+        self._dirty.clear()
+        if self._metrics is None:
+            self._db.set("TimerMod", "active_timers", dict(self._entries))
+            return
+        with self._metrics.timer("db_save"):
+            self._db.set("TimerMod", "active_timers", dict(self._entries))
+        self._metrics.incr("db_saves")
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity. FloodWait блокирует ведро до срока."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до появления токена."""
+        self._refill(now)
+        wait = self.blocked_until - now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return max(0.0, wait)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def penalize(self, now: float, seconds: float):
+        """Учитывает FloodWait: ведро пустеет и блокируется на seconds."""
+        self._refill(now)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+class RateLimiter:
+    """
+    Проактивный лимитер исходящих edit/delete/send: ведро на каждый чат плюс
+    общее ведро аккаунта. Операции с одинаковым key (рендер одной формы)
+    вытесняют друг друга — выполняется только самая свежая. FloodWait штрафует
+    ведро своего чата, поэтому остальные чаты продолжают работать. Приоритетные
+    операции (удаление закончившегося таймера) пропускаются вперёд обычных в своём чате.
+    """
+
+    CHAT_BURST = 5
+    GLOBAL_BURST = 30
+
+    def __init__(self, chat_rate, global_rate, metrics=None):
+        self._chat_rate = chat_rate  # callable -> операций в секунду на чат
+        self._global_rate = global_rate  # callable -> операций в секунду на аккаунт
+        self._metrics = metrics
+        self._chats = {}
+        self._global = None
+        self._latest = {}  # {key: поколение самой свежей операции}
+        self._priority = {}  # {chat_id: сколько приоритетных операций ждут токен}
+
+    def _buckets(self, chat_id, now):
+        if self._global is None:
+            self._global = TokenBucket(self._global_rate(), self.GLOBAL_BURST, now)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate(), self.CHAT_BURST, now)
+        bucket.rate = self._chat_rate()
+        self._global.rate = self._global_rate()
+        return bucket, self._global
+
+    def supersede(self, key):
+        """Отменяет все ожидающие операции с данным key."""
+        if key in self._latest:
+            self._latest[key] += 1
+
+    async def run(self, chat_id, action, key=None, priority=False):
+        """
+        Выполняет action() после получения токенов чата и аккаунта и возвращает
+        его результат. Если пока ждали, пришла более свежая операция с тем же key,
+        возвращает None без вызова. После FloodWait повторяет один раз.
+        Пока в чате ждёт priority-операция, обычные токен не берут.
+        """
+        loop = asyncio.get_event_loop()
+        if key is not None:
+            gen = self._latest[key] = self._latest.get(key, 0) + 1
+        waiting = priority  # Держим очередь чата, пока не взяли токен
+        if waiting:
+            self._priority[chat_id] = self._priority.get(chat_id, 0) + 1
+        try:
+            for attempt in range(2):
+                while True:
+                    if key is not None and self._latest.get(key) != gen:
+                        return None  # Вытеснена более свежей операцией
+                    now = loop.time()
+                    chat_bucket, global_bucket = self._buckets(chat_id, now)
+                    wait = max(chat_bucket.delay(now), global_bucket.delay(now))
+                    if wait <= 0 and (priority or not self._priority.get(chat_id)):
+                        chat_bucket.take(now)
+                        global_bucket.take(now)
+                        if waiting:
+                            waiting = False
+                            self._release_priority(chat_id)
+                        break
+                    # Уступаем приоритетной операции: проверяем снова через интервал токена
+                    await asyncio.sleep(wait if wait > 0 else 1 / chat_bucket.rate)
+                try:
+                    return await action()
+                except FloodWaitError as e:
+                    self._chats[chat_id].penalize(loop.time(), e.seconds)
+                    if self._metrics is not None:
+                        self._metrics.flood(e.seconds)
+                    logger.warning("FloodWait chat_id=%s seconds=%s attempt=%s", chat_id, e.seconds, attempt + 1)
+                    if attempt:
+                        raise
+        finally:
+            if waiting:
+                self._release_priority(chat_id)
+            if key is not None and self._latest.get(key) == gen:
+                del self._latest[key]
+
+    def _release_priority(self, chat_id):
+        left = self._priority.get(chat_id, 0) - 1
+        if left > 0:
+            self._priority[chat_id] = left
+        else:
+            self._priority.pop(chat_id, None)
+
 @loader.tds
 class TimerMod(loader.Module):
     """
@@ -64,7 +410,7 @@ class TimerMod(loader.Module):
             "Используйте формат: .timer {время} [текст сообщения]\n"
             "Поддержка комбинаций: {10m 5s}, {2h 30m} и т.д.\n"
             "Пример: .timer 10m Привет, это тест!\n"
-            "Таймер будет отображаться на инлайн-кнопке (пауза/возобновить) и обновляться каждую секунду."
+            "Таймер будет отображаться на инлайн-кнопке (пауза/возобновить); ближе к концу он обновляется каждую секунду."
         ),
         "invalid_time_format": (
             "❌ Неверный формат времени: {}\n"
@@ -78,9 +424,41 @@ class TimerMod(loader.Module):
         "failed_to_reset": "Не удалось сбросить таймер: {}",
         "no_active_timers": "Нет активных таймеров для остановки.",
         "all_timers_stopped": "Все {0} таймера остановлены и удалены.",
+        "timerstats": (
+            "📊 <b>Статистика таймеров</b> за {uptime}\n"
+            "Активных: {active}, на паузе: {paused}\n"
+            "Edit'ов: {renders} ({rate:.2f}/с), сэкономлено каденсом: {edits_saved}\n"
+            "Дедупликация: {dedup_hits} пропущено / {dedup_misses} отправлено\n"
+            "Ошибок рендера: {render_fails}, удалено таймеров: {timers_dropped}\n"
+            "FloodWait: {flood_waits} раз, {flood_seconds} с\n"
+            "Записей в БД: {db_saves}, пробуждений планировщика: {wakeups}, тиков: {ticks}\n\n"
+            "<b>Длительности</b> (p50 / p90 / p99 / max)\n"
+            "{histograms}"
+        ),
+        "timerstats_histogram": "{name}: {p50} / {p90} / {p99} / {max} мс (n={count})",
+        "timerstats_no_data": "{name}: нет данных",
+        "timerstats_reset": "📊 Статистика таймеров сброшена.",
+        "timerbench_running": "⏱ Бенчмарк планировщика: {counts} таймеров, ~{seconds} с...",
+        "timerbench_result": (
+            "⏱ <b>Бенчмарк планировщика</b>: таймеры по {min_seconds}–{seconds} с, edit {edit_min}–{edit_max} с\n\n"
+            "{rows}"
+        ),
+        "timerbench_row": (
+            "<b>{count}</b> таймеров: пробуждений {wakeup_rate:.1f}/с, тиков на таймер {tick_rate:.2f}/с\n"
+            "Edit'ов: {renders}, пропущено дедупликацией: {dedup_hits}\n"
+            "Удаление после дедлайна: p50 {p50} / p99 {p99} / max {max} мс ({expired}/{count} удалено)"
+        ),
+        "timerbench_bad_args": "❌ Укажите до {0} чисел таймеров, каждое от 1 до {1}.",
         "config_running_timer_emoji_doc": "Emoji для кнопки таймера, когда он активен (по умолчанию: ⏸️).",
         "config_paused_timer_emoji_doc": "Emoji для кнопки таймера, когда он приостановлен (по умолчанию: ▶️).",
         "config_reset_button_emoji_doc": "Emoji для кнопки сброса таймера (по умолчанию: ⏹️).",
+        "config_save_interval_doc": "Интервал (в секундах) пакетной записи изменений таймеров в базу данных (по умолчанию: 5).",
+        "config_fine_render_window_doc": "За сколько секунд до конца таймер обновляется каждую секунду (по умолчанию: 60).",
+        "config_medium_render_window_doc": "За сколько секунд до конца таймер обновляется с шагом medium_render_step (по умолчанию: 3600). Раньше — с шагом coarse_render_step.",
+        "config_medium_render_step_doc": "Шаг обновления (в секундах) в среднем окне (по умолчанию: 10).",
+        "config_coarse_render_step_doc": "Шаг обновления (в секундах) вдали от конца (по умолчанию: 60).",
+        "config_chat_edits_per_minute_doc": "Сколько edit/delete/send модуль делает в минуту в одном чате (по умолчанию: 60).",
+        "config_global_edits_per_second_doc": "Сколько edit/delete/send модуль делает в секунду на весь аккаунт (по умолчанию: 20).",
         "_cls_doc": "Устанавливает таймер: inline.form с текстом и кнопками \"Пауза/Возобновить\" и \"Сброс\" (появляется при паузе). При перезагрузке бота таймеры восстанавливаются.",
         "_cmd_doc_timer": (
             "Устанавливает таймер.\n"
@@ -88,7 +466,9 @@ class TimerMod(loader.Module):
             "Пример: .timer 10m Тест!\n"
             "Кнопка таймера позволяет ставить на паузу/возобновлять, кнопка сброса (видна при паузе) удаляет таймер. Исходная команда удаляется."
         ),
-        "_cmd_doc_stoptimer": "Останавливает и удаляет все активные таймеры, запущенные модулем."
+        "_cmd_doc_stoptimer": "Останавливает и удаляет все активные таймеры, запущенные модулем.",
+        "_cmd_doc_timerstats": "Показывает метрики таймеров: edit'ы, FloodWait, ошибки рендера, задержки. .timerstats reset — обнулить.",
+        "_cmd_doc_timerbench": "Прогоняет синтетические таймеры с медленным edit на отдельном планировщике и показывает пробуждения, тики и отставание удаления. .timerbench [число таймеров ...] — по прогону на каждое число"
     }
 
     strings_ru = {
@@ -97,7 +477,7 @@ class TimerMod(loader.Module):
             "Используйте формат: .timer {время} [текст сообщения]\n"
             "Поддержка комбинаций: {10m 5s}, {2h 30m} и т.д.\n"
             "Пример: .timer 10m Привет, это тест!\n"
-            "Таймер будет отображаться на инлайн-кнопке (пауза/возобновить) и обновляться каждую секунду."
+            "Таймер будет отображаться на инлайн-кнопке (пауза/возобновить); ближе к концу он обновляется каждую секунду."
         ),
         "invalid_time_format": (
             "❌ Неверный формат времени: {}\n"
@@ -111,9 +491,41 @@ class TimerMod(loader.Module):
         "failed_to_reset": "Не удалось сбросить таймер: {}",
         "no_active_timers": "Нет активных таймеров для остановки.",
         "all_timers_stopped": "Все {0} таймера остановлены и удалены.",
+        "timerstats": (
+            "📊 <b>Статистика таймеров</b> за {uptime}\n"
+            "Активных: {active}, на паузе: {paused}\n"
+            "Edit'ов: {renders} ({rate:.2f}/с), сэкономлено каденсом: {edits_saved}\n"
+            "Дедупликация: {dedup_hits} пропущено / {dedup_misses} отправлено\n"
+            "Ошибок рендера: {render_fails}, удалено таймеров: {timers_dropped}\n"
+            "FloodWait: {flood_waits} раз, {flood_seconds} с\n"
+            "Записей в БД: {db_saves}, пробуждений планировщика: {wakeups}, тиков: {ticks}\n\n"
+            "<b>Длительности</b> (p50 / p90 / p99 / max)\n"
+            "{histograms}"
+        ),
+        "timerstats_histogram": "{name}: {p50} / {p90} / {p99} / {max} мс (n={count})",
+        "timerstats_no_data": "{name}: нет данных",
+        "timerstats_reset": "📊 Статистика таймеров сброшена.",
+        "timerbench_running": "⏱ Бенчмарк планировщика: {counts} таймеров, ~{seconds} с...",
+        "timerbench_result": (
+            "⏱ <b>Бенчмарк планировщика</b>: таймеры по {min_seconds}–{seconds} с, edit {edit_min}–{edit_max} с\n\n"
+            "{rows}"
+        ),
+        "timerbench_row": (
+            "<b>{count}</b> таймеров: пробуждений {wakeup_rate:.1f}/с, тиков на таймер {tick_rate:.2f}/с\n"
+            "Edit'ов: {renders}, пропущено дедупликацией: {dedup_hits}\n"
+            "Удаление после дедлайна: p50 {p50} / p99 {p99} / max {max} мс ({expired}/{count} удалено)"
+        ),
+        "timerbench_bad_args": "❌ Укажите до {0} чисел таймеров, каждое от 1 до {1}.",
         "config_running_timer_emoji_doc": "Emoji для кнопки таймера, когда он активен (по умолчанию: ⏸️).",
         "config_paused_timer_emoji_doc": "Emoji для кнопки таймера, когда он приостановлен (по умолчанию: ▶️).",
         "config_reset_button_emoji_doc": "Emoji для кнопки сброса таймера (по умолчанию: ⏹️).",
+        "config_save_interval_doc": "Интервал (в секундах) пакетной записи изменений таймеров в базу данных (по умолчанию: 5).",
+        "config_fine_render_window_doc": "За сколько секунд до конца таймер обновляется каждую секунду (по умолчанию: 60).",
+        "config_medium_render_window_doc": "За сколько секунд до конца таймер обновляется с шагом medium_render_step (по умолчанию: 3600). Раньше — с шагом coarse_render_step.",
+        "config_medium_render_step_doc": "Шаг обновления (в секундах) в среднем окне (по умолчанию: 10).",
+        "config_coarse_render_step_doc": "Шаг обновления (в секундах) вдали от конца (по умолчанию: 60).",
+        "config_chat_edits_per_minute_doc": "Сколько edit/delete/send модуль делает в минуту в одном чате (по умолчанию: 60).",
+        "config_global_edits_per_second_doc": "Сколько edit/delete/send модуль делает в секунду на весь аккаунт (по умолчанию: 20).",
         "_cls_doc": "Устанавливает таймер: inline.form с текстом и кнопками \"Пауза/Возобновить\" и \"Сброс\" (появляется при паузе). При перезагрузке бота таймеры восстанавливаются.",
         "_cmd_doc_timer": (
             "Устанавливает таймер.\n"
@@ -121,12 +533,41 @@ class TimerMod(loader.Module):
             "Пример: .timer 10m Тест!\n"
             "Кнопка таймера позволяет ставить на паузу/возобновлять, кнопка сброса (видна при паузе) удаляет таймер. Исходная команда удаляется."
         ),
-        "_cmd_doc_stoptimer": "Останавливает и удаляет все активные таймеры, запущенные модулем."
+        "_cmd_doc_stoptimer": "Останавливает и удаляет все активные таймеры, запущенные модулем.",
+        "_cmd_doc_timerstats": "Показывает метрики таймеров: edit'ы, FloodWait, ошибки рендера, задержки. .timerstats reset — обнулить.",
+        "_cmd_doc_timerbench": "Прогоняет синтетические таймеры с медленным edit на отдельном планировщике и показывает пробуждения, тики и отставание удаления. .timerbench [число таймеров ...] — по прогону на каждое число"
     }
 
+    # Окно, в пределах которого планировщик обрабатывает таймеры за одно пробуждение
+    SCHEDULER_SLACK = 0.25
+    # Сколько чатов восстанавливаются одновременно после перезагрузки
+    RESTORE_CONCURRENCY = 4
+    # Попытки восстановить таймер и пауза перед первым повтором (дальше удваивается)
+    RESTORE_ATTEMPTS = 3
+    RESTORE_BACKOFF = 2.0
+    # Параметры .timerbench: длительность прогона, задержка синтетического edit, лимит таймеров
+    BENCH_SECONDS = 10
+    BENCH_EDIT_DELAY = (0.05, 0.5)
+    BENCH_MAX_TIMERS = 500
+    BENCH_MAX_RUNS = 5
+    # По умолчанию — рост числа таймеров на порядок: пробуждения в секунду должны оставаться на месте
+    BENCH_DEFAULT_TIMERS = (1, 10, 100)
+
     def __init__(self):
-        # {form_id: {'text': str, 'total_duration': int, 'remaining': int, 'chat_id': int, 'form_obj': obj, 'is_paused': bool, 'task': asyncio.Task, 'resume_event': asyncio.Event, 'render_fails': int, 'prev_paused': bool}}
+        # {form_id: TimerState}
         self.timers = {} 
+        # Общий планировщик: min-heap из (due, seq, form_id). Устаревшие записи
+        # отбрасываются лениво по несовпадению seq с TimerState.heap_seq.
+        self._heap = []
+        self._heap_counter = itertools.count()
+        self._wakeup = None
+        self._scheduler_task = None
+        self._restore_task = None
+        self._tick_tasks = set()
+        self._store = None
+        # Счётчики рендера (edit'ы, каденс, дедупликация), FloodWait и ошибок,
+        # плюс гистограммы длительностей рендера, отставания тиков и записи в БД
+        self._metrics = TimerMetrics()
         self.config = loader.ModuleConfig(
             loader.ConfigValue(
                 "running_timer_emoji",
@@ -146,6 +587,53 @@ class TimerMod(loader.Module):
                 lambda: self.strings("config_reset_button_emoji_doc"),
                 validator=loader.validators.String(),
             ),
+            loader.ConfigValue(
+                "save_interval",
+                5,  # Debounce interval for DB writes
+                lambda: self.strings("config_save_interval_doc"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "fine_render_window",
+                60,  # Per-second updates in the last N seconds
+                lambda: self.strings("config_fine_render_window_doc"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "medium_render_window",
+                3600,  # Medium-step updates in the last N seconds
+                lambda: self.strings("config_medium_render_window_doc"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "medium_render_step",
+                10,
+                lambda: self.strings("config_medium_render_step_doc"),
+                validator=loader.validators.Integer(minimum=1),
+            ),
+            loader.ConfigValue(
+                "coarse_render_step",
+                60,
+                lambda: self.strings("config_coarse_render_step_doc"),
+                validator=loader.validators.Integer(minimum=1),
+            ),
+            loader.ConfigValue(
+                "chat_edits_per_minute",
+                60,  # One edit per second per chat on average
+                lambda: self.strings("config_chat_edits_per_minute_doc"),
+                validator=loader.validators.Integer(minimum=1),
+            ),
+            loader.ConfigValue(
+                "global_edits_per_second",
+                20,
+                lambda: self.strings("config_global_edits_per_second_doc"),
+                validator=loader.validators.Integer(minimum=1),
+            ),
+        )
+        self._limiter = RateLimiter(
+            lambda: self.config["chat_edits_per_minute"] / 60,
+            lambda: self.config["global_edits_per_second"],
+            self._metrics,
         )
 
 
@@ -153,83 +641,206 @@ class TimerMod(loader.Module):
         self.client = client
         self.db = db
 
-        saved_timers = self.db.get("TimerMod", "active_timers", {})
-        updated_saved_timers = {}  # Для сохранения только валидных таймеров с новыми ID
-        has_changes = False
+        self._wakeup = asyncio.Event()
+        self._scheduler_task = asyncio.ensure_future(self._scheduler_loop())
+        self._store = TimerStore(db, lambda: self.config["save_interval"], self._metrics)
 
-        for form_id_str, data in saved_timers.items():
+        entries = []
+        for form_id_str, data in self._store.saved().items():
             try:
-                old_form_id = int(form_id_str)
-                if old_form_id in self.timers:
-                    continue  # Уже обработан
-
-                # Проверяем формат data: ожидается кортеж/список из ровно 4 элементов
-                if not isinstance(data, (tuple, list)) or len(data) != 4:
-                    print(f"Skipping invalid saved timer {form_id_str}: data has {len(data) if isinstance(data, (tuple, list)) else 'unknown'} elements, expected 4.")
-                    has_changes = True
-                    continue
+                form_id = int(form_id_str)
+                _, remaining_seconds, chat_id, is_paused_state = TimerState.from_db(data)
+            except (ValueError, TypeError) as e:
+                logger.warning("Skipping saved timer form_id=%s: %s", form_id_str, e)
+                self._store.stage(form_id_str, None)
+                continue
+            if remaining_seconds <= 0:
+                # Timer finished while the bot was offline
+                self._store.stage(form_id_str, None)
+                continue
+            # Паузы не торопятся — их восстанавливаем в последнюю очередь
+            urgency = float("inf") if is_paused_state else remaining_seconds
+            entries.append((urgency, form_id, chat_id, data))
+
+        self._store.flush()
+        # Восстановление идёт в фоне и не задерживает загрузку юзербота
+        self._restore_task = asyncio.ensure_future(self._restore_timers(entries))
+
+    async def _restore_timers(self, entries):
+        """
+        Восстанавливает сохранённые таймеры: чаты обрабатываются параллельно
+        (не больше RESTORE_CONCURRENCY отправок одновременно), внутри чата —
+        по очереди, самые скорые таймеры первыми. Отправка идёт через общий лимитер.
+        """
+        by_chat = {}
+        for urgency, form_id, chat_id, data in sorted(entries, key=lambda entry: entry[0]):
+            by_chat.setdefault(chat_id, []).append((form_id, data))
 
-                original_text, remaining_seconds, chat_id, is_paused_state = data
-                
-                if remaining_seconds > 0:
-                    # Create a fallback message as we can't restore InlineForm directly
-                    fallback_msg = await self.client.send_message(chat_id, original_text)
-                    new_form_id = fallback_msg.id  # Новый ID для восстановленного таймера
-                    
-                    # Create resume_event for the restored timer
-                    resume_event = asyncio.Event()
-                    if is_paused_state:
-                        resume_event.clear()  # Ensure it's cleared if paused on restore
-                    
-                    # Store timer data with the new message object and NEW form_id
-                    self.timers[new_form_id] = {
-                        'text': original_text,
-                        'total_duration': remaining_seconds, # On restore, total_duration becomes remaining_seconds
-                        'remaining': remaining_seconds,
-                        'chat_id': chat_id,
-                        'form_obj': fallback_msg,
-                        'is_paused': is_paused_state,
-                        'task': None, # Task will be set when _run_timer starts
-                        'resume_event': resume_event,
-                        'render_fails': 0,  # Counter for failed renders
-                        'prev_paused': is_paused_state # Previous pause state for render check
-                    }
-                    
-                    # Render initial state with correct buttons using NEW form_id
-                    await self._render_timer_buttons(fallback_msg, original_text, remaining_seconds, is_paused_state, new_form_id)
-
-                    # Start the timer task and store its handle with NEW form_id
-                    task_handle = asyncio.create_task(self._run_timer(new_form_id))
-                    self.timers[new_form_id]['task'] = task_handle
-
-                    # Сохраняем валидный таймер с НОВЫМ ключом в обновленной БД
-                    updated_saved_timers[str(new_form_id)] = data
+        semaphore = asyncio.Semaphore(self.RESTORE_CONCURRENCY)
+
+        async def restore_chat(chat_entries):
+            for form_id, data in chat_entries:
+                for attempt in range(self.RESTORE_ATTEMPTS):
+                    # Слот берётся на каждую попытку, чтобы длинная очередь одного чата не держала остальные
+                    async with semaphore:
+                        try:
+                            await self._restore_timer(form_id, data)
+                            break
+                        except Exception as e:
+                            logger.warning(
+                                "Failed to restore timer form_id=%s attempt=%s: %s", form_id, attempt + 1, e
+                            )
+                    if attempt + 1 < self.RESTORE_ATTEMPTS:
+                        await asyncio.sleep(self.RESTORE_BACKOFF * 2 ** attempt)
                 else:
-                    # If remaining_seconds is 0 or less, it means timer finished, remove from DB
-                    has_changes = True
+                    # Сбой может быть временным (сеть, FloodWait): запись в БД остаётся
+                    # и таймер восстановится при следующей загрузке
+                    logger.warning("Giving up on restoring timer form_id=%s, keeping it saved", form_id)
 
-            except (ValueError, TypeError) as e:
-                print(f"Skipping saved timer {form_id_str} due to unpack error: {e}")
-                has_changes = True
-                continue
+        # by_chat сохраняет порядок вставки: чаты с самыми скорыми таймерами стартуют первыми
+        await asyncio.gather(*(restore_chat(chat_entries) for chat_entries in by_chat.values()))
+        self._store.flush()
 
-        # Обновляем БД только если были изменения (удалены некорректные таймеры или созданы новые)
-        if has_changes or updated_saved_timers:
-            self.db.set("TimerMod", "active_timers", updated_saved_timers)
+    async def _restore_timer(self, form_id: int, data):
+        """
+        Отправляет восстановленный таймер сразу инлайн-формой с кнопками —
+        один запрос вместо send_message + get_messages + edit. Таймер остаётся
+        под прежним ключом, поэтому запись в БД не переименовывается.
+        """
+        if form_id in self.timers:
+            return  # Уже обработан
+        # remaining пересчитывается здесь: пока шла очередь, время шло
+        original_text, remaining_seconds, chat_id, is_paused_state = TimerState.from_db(data)
+        if remaining_seconds <= 0:
+            self._persist(form_id)
+            return
 
+        # On restore, total_duration becomes remaining_seconds
+        timer_data = TimerState(original_text, remaining_seconds, chat_id, None, is_paused_state)
+        shown = remaining_seconds if is_paused_state else self._render_plan(timer_data.remaining())[0]
+        display_text, buttons = self._timer_buttons(form_id, shown, is_paused_state)
 
-    async def _save_timers(self):
-        """Сохраняет текущее состояние таймеров в базу данных (без form_obj и task)."""
-        timers_to_save = {}
-        for form_id, timer_data in self.timers.items():
-            # Проверяем наличие всех необходимых ключей перед сохранением
-            required_keys = ['text', 'remaining', 'chat_id', 'is_paused']
-            if all(key in timer_data for key in required_keys) and timer_data['remaining'] > 0:
-                timers_to_save[form_id] = (timer_data['text'], timer_data['remaining'], timer_data['chat_id'], timer_data['is_paused'])
-        self.db.set("TimerMod", "active_timers", timers_to_save)
+        timer_form = await self._limiter.run(
+            chat_id,
+            lambda: self.inline.form(text=original_text, message=chat_id, reply_markup=buttons, silent=True),
+        )
+        if not timer_form:
+            raise RuntimeError("inline form was not sent")
 
-    async def _render_timer_buttons(self, form_or_msg, original_text, remaining_seconds, is_paused, form_id):
-        """Helper to render or update the timer message buttons."""
+        timer_data.form_obj = timer_form
+        timer_data.last_render = (original_text, display_text, is_paused_state)
+        self.timers[form_id] = timer_data
+
+        # Paused timers stay out of the heap until resumed
+        if not is_paused_state:
+            self._schedule(form_id, self._render_plan(timer_data.remaining())[1])
+        self._persist(form_id)
+
+    async def on_unload(self):
+        if self._restore_task:
+            self._restore_task.cancel()
+        if self._scheduler_task:
+            self._scheduler_task.cancel()
+        for task in list(self._tick_tasks):
+            task.cancel()
+        if self._store:
+            self._store.flush()
+
+    def _render_step(self, remaining: float) -> int:
+        """Шаг обновления кнопки: чем дальше до конца, тем реже."""
+        if remaining <= self.config["fine_render_window"]:
+            return 1
+        if remaining <= self.config["medium_render_window"]:
+            return self.config["medium_render_step"]
+        return self.config["coarse_render_step"]
+
+    def _render_plan(self, remaining: float):
+        """
+        Возвращает (shown, delay): остаток, округлённый вверх до текущего шага,
+        и через сколько секунд показанное значение сменится — на следующем
+        кратном шагу или на границе окна, где шаг уменьшается.
+        """
+        step = self._render_step(remaining)
+        shown = step * _ceil_seconds(remaining / step)
+        next_at = shown - step
+        for boundary in (self.config["fine_render_window"], self.config["medium_render_window"]):
+            if next_at < boundary < remaining:
+                next_at = boundary
+        return shown, max(0.0, remaining - next_at)
+
+    def _next_delay(self, timer_data, due):
+        """
+        Через сколько секунд от текущего момента следующий тик после тика на due.
+        Планировщик будит до SCHEDULER_SLACK раньше срока: план считается на момент
+        не раньше due, иначе следующий тик попал бы на тот же due и крутился бы до его наступления.
+        """
+        now = asyncio.get_event_loop().time()
+        at = max(now, due)
+        return self._render_plan(timer_data.remaining(at))[1] + (at - now)
+
+    def _schedule(self, form_id, delay):
+        """Ставит таймер в кучу планировщика через delay секунд (O(log n))."""
+        timer_data = self.timers[form_id]
+        due = asyncio.get_event_loop().time() + delay
+        seq = next(self._heap_counter)
+        timer_data.heap_seq = seq
+        heapq.heappush(self._heap, (due, seq, form_id))
+        # Будим планировщик, только если новая запись стала ближайшей
+        if self._heap[0][1] == seq and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _unschedule(self, form_id):
+        """Снимает таймер с планировщика: запись в куче станет устаревшей (O(1))."""
+        timer_data = self.timers.get(form_id)
+        if timer_data:
+            timer_data.heap_seq = None
+
+    async def _scheduler_loop(self):
+        """
+        Единый цикл для всех таймеров: спит до ближайшего дедлайна в куче
+        и запускает тики только для таймеров, которым пора обновиться.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            self._metrics.incr("wakeups")
+            self._wakeup.clear()
+            horizon = loop.time() + self.SCHEDULER_SLACK
+            while self._heap and self._heap[0][0] <= horizon:
+                due, seq, form_id = heapq.heappop(self._heap)
+                timer_data = self.timers.get(form_id)
+                if not timer_data or timer_data.heap_seq != seq:
+                    continue  # Устаревшая запись (пауза, сброс или перепланирование)
+                timer_data.heap_seq = None
+                if timer_data.ticking:
+                    # Предыдущий тик ещё идёт: он выполнит этот тик сам, сразу после своего,
+                    # без лишнего пробуждения планировщика. Если его рендер всё ещё ждёт токен,
+                    # значение на нём уже устарело — вытесняем рендер, чтобы тик не отставал
+                    timer_data.missed_due = due
+                    self._limiter.supersede(form_id)
+                    continue
+                timer_data.ticking = True
+                task = asyncio.ensure_future(self._tick_timer(form_id, due))
+                self._tick_tasks.add(task)
+                task.add_done_callback(self._tick_tasks.discard)
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0, self._heap[0][0] - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    def _persist(self, form_id, flush=False):
+        """Ставит запись таймера (или её удаление) в очередь на запись в БД."""
+        timer_data = self.timers.get(form_id)
+        self._store.stage(form_id, timer_data.to_db() if timer_data else None)
+        if flush:
+            self._store.flush()
+
+    def _timer_buttons(self, form_id, remaining_seconds, is_paused):
+        """Собирает (текст кнопки таймера, разметку) для формы таймера."""
         timer_text_formatted = _format_seconds_to_hms(remaining_seconds)
         
         timer_emoji = self.config["paused_timer_emoji"] if is_paused else self.config["running_timer_emoji"]
@@ -242,91 +853,110 @@ class TimerMod(loader.Module):
         # Кнопка сброса появляется только когда таймер приостановлен
         if is_paused:
             buttons.append([{"text": f"{self.config['reset_button_emoji']} Сбросить", "callback": self._reset_timer_callback, "args":(form_id,)}])
+        return timer_display_text, buttons
+
+    async def _render_timer_buttons(self, form_or_msg, original_text, remaining_seconds, is_paused, form_id):
+        """Helper to render or update the timer message buttons."""
+        timer_display_text, buttons = self._timer_buttons(form_id, remaining_seconds, is_paused)
+
+        timer_data = self.timers.get(form_id)
+        chat_id = timer_data.chat_id if timer_data else None
+
+        # Отпечаток того, что увидит пользователь: если он совпадает с последним
+        # успешным edit'ом этой формы, запрос к API не нужен
+        fingerprint = (original_text, timer_display_text, is_paused)
+        if timer_data and timer_data.last_render == fingerprint:
+            self._metrics.incr("dedup_hits")
+            return
+        self._metrics.incr("dedup_misses")
+
+        async def edit(target, **kwargs):
+            # Замеряется сам запрос к API, без ожидания в лимитере
+            with self._metrics.timer("render"):
+                await target.edit(original_text, **kwargs)
+            # Считаем только дошедшие до API edit'ы: вытесненные в лимитере сюда не попадают
+            self._metrics.incr("renders")
+            if timer_data:
+                timer_data.last_render = fingerprint
 
         try:
+            # Все edit'ы идут через лимитер; ожидающий рендер той же формы вытесняется новым
             if hasattr(form_or_msg, 'edit'):
-                await form_or_msg.edit(original_text, reply_markup=buttons)
+                await self._limiter.run(chat_id, lambda: edit(form_or_msg, reply_markup=buttons), key=form_id)
             else:
-                # Fallback for plain Message objects (e.g., from client_ready)
-                msg_entity = await self.client.get_messages(self.timers[form_id]['chat_id'], ids=form_id)
+                # Fallback for plain Message objects (e.g., when no inline form was created)
+                msg_entity = await self.client.get_messages(chat_id, ids=form_id)
                 if msg_entity:
-                    await msg_entity.edit(original_text, buttons=buttons)
+                    await self._limiter.run(chat_id, lambda: edit(msg_entity, buttons=buttons), key=form_id)
                     # Update the stored form_obj if we successfully found and edited it
-                    self.timers[form_id]['form_obj'] = msg_entity
+                    if form_id in self.timers:
+                        self.timers[form_id].form_obj = msg_entity
                 else:
                     # If message not found (deleted?), remove timer
-                    print(f"Message for timer {form_id} not found during render, removing timer.")
+                    logger.warning("Message for timer form_id=%s not found during render, removing timer", form_id)
                     if form_id in self.timers:
                         del self.timers[form_id]
-                    await self._save_timers()
+                        self._metrics.incr("timers_dropped")
+                    self._persist(form_id)
                     return  # Exit to avoid further errors
-        except FloodWaitError as e:
-            await asyncio.sleep(e.seconds)  # Авто-сон при flood
-            # Retry once after sleep
-            if hasattr(form_or_msg, 'edit'):
-                await form_or_msg.edit(original_text, reply_markup=buttons)
-            else:
-                msg_entity = await self.client.get_messages(self.timers[form_id]['chat_id'], ids=form_id)
-                if msg_entity:
-                    await msg_entity.edit(original_text, buttons=buttons)
-                    self.timers[form_id]['form_obj'] = msg_entity
-                else:
-                    print(f"Retry failed: Message for timer {form_id} not found, removing timer.")
-                    if form_id in self.timers:
-                        del self.timers[form_id]
-                    await self._save_timers()
-                    return
         except Exception as e:
-            print(f"Failed to render buttons for timer {form_id}: {e}")
+            self._metrics.incr("render_fails")
+            logger.warning("Failed to render buttons for timer form_id=%s chat_id=%s: %s", form_id, chat_id, e)
             # Increment fail counter
             if form_id in self.timers:
                 timer_data = self.timers[form_id]
-                timer_data['render_fails'] = timer_data.get('render_fails', 0) + 1
-                if timer_data['render_fails'] >= 3:
-                    print(f"Too many render fails for timer {form_id}, removing it.")
+                timer_data.render_fails = timer_data.render_fails + 1
+                if timer_data.render_fails >= 3:
+                    logger.warning("Too many render fails for timer form_id=%s, removing it", form_id)
                     del self.timers[form_id]
-                    await self._save_timers()
-                self.timers[form_id] = timer_data
+                    self._metrics.incr("timers_dropped")
+                    self._persist(form_id)
             # For now, continue without removing to allow recovery.
 
 
     async def _toggle_timer_callback(self, call, form_id: int):
         """Callback to pause/resume the timer."""
         timer_data = self.timers.get(form_id)
-        if not timer_data or timer_data['remaining'] <= 0:
+        now = asyncio.get_event_loop().time()
+        if not timer_data or timer_data.remaining(now) <= 0:
             await call.answer(self.strings("timer_inactive"))
             return
 
         # Toggle the pause state
-        new_paused = not timer_data['is_paused']
-        timer_data['is_paused'] = new_paused
-        timer_data['prev_paused'] = new_paused  # Update prev_paused to new state for immediate consistency
+        new_paused = not timer_data.is_paused
         
-        # If resuming (new_paused=False), signal the event to wake the task immediately
-        if not new_paused:
-            timer_data['resume_event'].set()
+        # Пауза замораживает остаток и снимает таймер с планировщика,
+        # возобновление сдвигает дедлайн на время паузы и возвращает в кучу
+        if new_paused:
+            timer_data.pause(now)
+            self._unschedule(form_id)
         else:
-            timer_data['resume_event'].clear()  # Clear for next pause cycle
-        
-        self.timers[form_id] = timer_data # Update the state
+            timer_data.resume(now)
+        remaining = _ceil_seconds(timer_data.remaining(now))
+        if not new_paused:
+            remaining, delay = self._render_plan(timer_data.remaining(now))
+            self._schedule(form_id, delay)
 
         # Re-render the board immediately to show the new state of buttons
         try:
-            await self._render_timer_buttons(timer_data['form_obj'], timer_data['text'], timer_data['remaining'], new_paused, form_id)
+            await self._render_timer_buttons(timer_data.form_obj, timer_data.text, remaining, new_paused, form_id)
         except Exception as e:
-            print(f"Render failed in toggle for timer {form_id}: {e}")
+            logger.warning("Render failed in toggle for timer form_id=%s: %s", form_id, e)
             # Retry once after short delay
             await asyncio.sleep(0.5)
             try:
-                await self._render_timer_buttons(timer_data['form_obj'], timer_data['text'], timer_data['remaining'], new_paused, form_id)
+                await self._render_timer_buttons(timer_data.form_obj, timer_data.text, remaining, new_paused, form_id)
             except Exception as retry_e:
-                print(f"Retry render also failed for timer {form_id}: {retry_e}")
+                logger.warning("Retry render also failed for timer form_id=%s: %s", form_id, retry_e)
         
-        await self._save_timers()  # Persist after render
+        # Пауза пишется сразу, возобновление — с дебаунсом (новый дедлайн)
+        self._persist(form_id, flush=new_paused)
 
         try:
             await call.answer(self.strings("timer_paused") if new_paused else self.strings("timer_resumed"))
         except FloodWaitError as e:
+            self._metrics.flood(e.seconds)
+            logger.warning("FloodWait on callback answer form_id=%s seconds=%s", form_id, e.seconds)
             await asyncio.sleep(e.seconds)  # Handle flood in answer
             await call.answer(self.strings("timer_paused") if new_paused else self.strings("timer_resumed"))
 
@@ -337,130 +967,112 @@ class TimerMod(loader.Module):
             await call.answer(self.strings("timer_inactive"))
             return
 
-        # Cancel the associated asyncio task
-        if timer_data['task']:
-            timer_data['task'].cancel()
+        # Remove the timer from the scheduler
+        self._unschedule(form_id)
 
         try:
             # Delete the message itself
-            if hasattr(timer_data['form_obj'], 'delete'):
-                await timer_data['form_obj'].delete()
-            else:
-                await self.client.delete_messages(timer_data['chat_id'], [form_id])
-            await call.answer(self.strings("timer_reset"))
-        except FloodWaitError as e:
-            await asyncio.sleep(e.seconds)  # Auto-sleep on flood
-            if hasattr(timer_data['form_obj'], 'delete'):
-                await timer_data['form_obj'].delete()
-            else:
-                await self.client.delete_messages(timer_data['chat_id'], [form_id])
+            await self._delete_timer_message(form_id, timer_data)
             await call.answer(self.strings("timer_reset"))
         except Exception as e:
             await call.answer(self.strings("failed_to_reset").format(e))
-            print(f"Failed to delete timer {form_id} on reset: {e}")
+            logger.warning("Failed to delete timer form_id=%s on reset: %s", form_id, e)
         finally:
             if form_id in self.timers:
                 del self.timers[form_id]
-            await self._save_timers() # Ensure it's removed from DB
+            self._persist(form_id, flush=True) # Ensure it's removed from DB
 
-    async def _run_timer(self, form_id: int):
+    async def _delete_timer_message(self, form_id: int, timer_data):
         """
-        Асинхронная функция для обратного отсчёта с обновлением кнопки.
+        Удаляет сообщение таймера через лимитер, отменяя ожидающие рендеры формы.
+        Удаление приоритетное: оно не ждёт в очереди за рендерами других таймеров чата.
+        """
+        form_obj = timer_data.form_obj
+        chat_id = timer_data.chat_id
+        self._limiter.supersede(form_id)
+        if hasattr(form_obj, 'delete'):
+            await self._limiter.run(chat_id, form_obj.delete, priority=True)
+        else:
+            await self._limiter.run(chat_id, lambda: self.client.delete_messages(chat_id, [form_id]), priority=True)
+
+    async def _tick_timer(self, form_id: int, due: float):
+        """
+        Задача тика, запускаемая планировщиком. Если, пока шёл тик, наступил срок
+        следующего (missed_due), он выполняется тут же, в этой же задаче.
         """
         try:
-            resume_event = self.timers[form_id]['resume_event']
-            while True:
-                timer_data = self.timers.get(form_id)
-                if not timer_data:
-                    break # Timer was removed/reset externally
-
-                original_text = timer_data['text']
-                remaining = timer_data['remaining']
-                form_or_msg = timer_data['form_obj']
-                is_paused = timer_data['is_paused']
-                prev_paused = timer_data.get('prev_paused', False)
-
-                if remaining <= 0:
-                    break # Timer finished
-
-                # На паузе: ждем либо сигнала resume_event, либо 1с таймаута
-                if is_paused:
-                    done, pending = await asyncio.wait(
-                        [resume_event.wait(), asyncio.sleep(1)],
-                        return_when=asyncio.FIRST_COMPLETED
-                    )
-                    # If resume_event finished, it means we resumed, clear pending
-                    for p in pending:
-                        p.cancel()
-                    # Render only if pause state changed (should be handled in callback, but safety)
-                    render_needed = (is_paused != prev_paused)
-                    if render_needed:
-                        await self._render_timer_buttons(form_or_msg, original_text, remaining, is_paused, form_id)
-                        timer_data['prev_paused'] = is_paused
-                        self.timers[form_id] = timer_data
-                    continue  # Back to loop to check new is_paused
-
-                # Если running: всегда рендерим каждую секунду для гарантии обновления
+            while due is not None:
                 try:
-                    await self._render_timer_buttons(form_or_msg, original_text, remaining, is_paused, form_id)
-                except Exception as e:
-                    print(f"Render failed in run_timer for {form_id}: {e}")
-                    timer_data['render_fails'] = timer_data.get('render_fails', 0) + 1
-                    if timer_data['render_fails'] >= 3:
-                        print(f"Too many render fails for timer {form_id}, auto-removing.")
-                        del self.timers[form_id]
-                        await self._save_timers()
-                        break
-                    self.timers[form_id] = timer_data
-
-                # Декрементируем remaining
-                remaining -= 1
-                timer_data['remaining'] = remaining
-                self.timers[form_id] = timer_data
-                await self._save_timers() # Сохраняем каждую секунду для персистентности
+                    await self._tick_once(form_id, due)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Error in tick for timer form_id=%s", form_id)
+                timer_data = self.timers.get(form_id)
+                due = timer_data.missed_due if timer_data else None
+                if timer_data:
+                    timer_data.missed_due = None
+        finally:
+            timer_data = self.timers.get(form_id)
+            if timer_data:
+                timer_data.ticking = False
 
-                if remaining > 0:
-                    await asyncio.sleep(1) # Ждем 1 секунду перед следующим обновлением
-                else:
-                    break # Выходим без лишнего sleep на 0
-            
-            # Таймер закончился или был отменен, выполняем финальное удаление (если еще не удален)
-            if form_id in self.timers:
-                timer_data = self.timers[form_id]
-                original_text = timer_data['text']
-                form_or_msg_final = timer_data['form_obj']
-                chat_id = timer_data['chat_id']
+    async def _tick_once(self, form_id: int, due: float):
+        """
+        Один тик таймера: планирует следующий тик на момент смены показанного значения
+        (шаг задаёт _render_plan) и обновляет кнопку по дедлайну. Следующий тик
+        планируется до рендера: если рендер застрял в лимитере, планировщик вытеснит его,
+        и таймер не отстанет. Пропущенные тики не повторяются — остаток всегда считается заново.
+        """
+        timer_data = self.timers.get(form_id)
+        if not timer_data or timer_data.is_paused:
+            return
 
-                # Убедимся, что на кнопке отображается 00:00:00 перед удалением
-                try:
-                    await self._render_timer_buttons(form_or_msg_final, original_text, 0, False, form_id)
-                    await asyncio.sleep(1) # Дадим время, чтобы отобразилось 0
-                except Exception as e:
-                    print(f"Final render failed for timer {form_id}: {e}")
+        loop = asyncio.get_event_loop()
+        # Отставание тика от плана: сон планировщика, очередь событий, старт задачи
+        self._metrics.observe("scheduler_lag", max(0.0, loop.time() - due))
+        self._metrics.incr("ticks")
+        # Планировщик может разбудить чуть раньше срока — считаем на момент due
+        remaining = timer_data.remaining(max(loop.time(), due))
+        if _ceil_seconds(remaining) <= 0:
+            await self._finish_timer(form_id)
+            return
 
-                try:
-                    if hasattr(form_or_msg_final, 'delete'):
-                        await form_or_msg_final.delete()
-                    else:
-                        await self.client.delete_messages(chat_id, [form_id])
-                except FloodWaitError as e:
-                    await asyncio.sleep(e.seconds)
-                    if hasattr(form_or_msg_final, 'delete'):
-                        await form_or_msg_final.delete()
-                    else:
-                        await self.client.delete_messages(chat_id, [form_id])
-                except Exception as e:
-                    print(f"Delete failed for timer {form_id}: {e}")
-
-        except asyncio.CancelledError:
-            print(f"Timer task {form_id} was cancelled.")
-            # Удаление сообщения обрабатывается в _reset_timer_callback
+        shown = self._render_plan(remaining)[0]
+        delay = self._next_delay(timer_data, due)
+        # Edit'ы, которые посекундный рендер сделал бы до следующего тика
+        self._metrics.incr("edits_saved", max(0, _ceil_seconds(delay) - 1))
+        self._schedule(form_id, delay)
+        try:
+            await self._render_timer_buttons(timer_data.form_obj, timer_data.text, shown, False, form_id)
         except Exception as e:
-            print(f"Error in _run_timer for {form_id}: {e}")
+            logger.warning("Render failed in tick for timer form_id=%s: %s", form_id, e)
+            timer_data.render_fails = timer_data.render_fails + 1
+            if timer_data.render_fails >= 3:
+                logger.warning("Too many render fails for timer form_id=%s, auto-removing", form_id)
+                if self.timers.pop(form_id, None) is not None:
+                    self._metrics.incr("timers_dropped")
+                self._persist(form_id)
+
+    async def _finish_timer(self, form_id: int):
+        """Финальное удаление закончившегося таймера."""
+        timer_data = self.timers.get(form_id)
+        if not timer_data:
+            return
+
+        self._unschedule(form_id)
+
+        try:
+            # Сразу удаляем: отдельный рендер 00:00:00 и пауза перед удалением
+            # занимали бы токен чата и задерживали удаление остальных таймеров
+            try:
+                await self._delete_timer_message(form_id, timer_data)
+            except Exception as e:
+                logger.warning("Delete failed for timer form_id=%s: %s", form_id, e)
         finally:
             if form_id in self.timers: # Убедимся, что таймер удален из списка активных
                 del self.timers[form_id]
-            await self._save_timers() # Финальное сохранение, чтобы удалить завершенный таймер из БД
+            self._persist(form_id) # Удаляем завершенный таймер из БД
 
     @loader.command()
     async def timer(self, message: Message):
@@ -488,7 +1100,7 @@ class TimerMod(loader.Module):
             return await utils.answer(message, self.strings("invalid_time_format").format(str(e)))
 
         # Лимит на активные таймеры в чате
-        active_in_chat = sum(1 for fid, data in self.timers.items() if data['chat_id'] == message.chat_id)
+        active_in_chat = sum(1 for fid, data in self.timers.items() if data.chat_id == message.chat_id)
         if active_in_chat >= 5:
             await utils.answer(message, self.strings("too_many_timers"))
             return
@@ -502,46 +1114,35 @@ class TimerMod(loader.Module):
             [{"text": f"{self.config['running_timer_emoji']} {_format_seconds_to_hms(delay_seconds)}", "callback": self._toggle_timer_callback, "args":(initial_form_id,)}],
         ]
 
-        timer_form = await self.inline.form(
-            message=message,
-            text=original_text,
-            reply_markup=initial_buttons, # Передаем начальные кнопки для формы
-            silent=True
+        timer_form = await self._limiter.run(
+            message.chat_id,
+            lambda: self.inline.form(
+                message=message,
+                text=original_text,
+                reply_markup=initial_buttons, # Передаем начальные кнопки для формы
+                silent=True
+            ),
         )
 
         form_id = timer_form.id if hasattr(timer_form, 'id') else message.id 
         
-        # Create resume_event for the new timer
-        resume_event = asyncio.Event()
-        resume_event.clear()  # Initial state: not waiting
-        
         # Store initial timer data
-        self.timers[form_id] = {
-            'text': original_text,
-            'total_duration': delay_seconds,
-            'remaining': delay_seconds,
-            'chat_id': message.chat_id,
-            'form_obj': timer_form,
-            'is_paused': False,
-            'task': None, # Task will be set below
-            'resume_event': resume_event,
-            'render_fails': 0,  # Counter for failed renders
-            'prev_paused': False # Initial pause state
-        }
+        self.timers[form_id] = TimerState(original_text, delay_seconds, message.chat_id, timer_form)
 
-        # Start the timer task and store its handle
-        task_handle = asyncio.create_task(self._run_timer(form_id))
-        self.timers[form_id]['task'] = task_handle
+        # Hand the timer over to the shared scheduler. Первый рендер делает сама команда ниже,
+        # поэтому первый тик — на следующей смене показанного значения, а не сразу (иначе два одинаковых edit'а)
+        shown, delay = self._render_plan(delay_seconds)
+        self._schedule(form_id, delay)
 
-        await self._save_timers()
+        self._persist(form_id)
 
         # Update message with correct form_id in buttons
         # Эта функция теперь также отвечает за добавление кнопки сброса при необходимости
-        await self._render_timer_buttons(timer_form, original_text, delay_seconds, False, form_id)
+        await self._render_timer_buttons(timer_form, original_text, shown, False, form_id)
 
         # Удаляем исходную команду
         try:
-            await message.delete()
+            await self._limiter.run(message.chat_id, message.delete)
         except Exception:
             pass # Игнорируем
 
@@ -552,41 +1153,145 @@ class TimerMod(loader.Module):
             await utils.answer(message, self.strings("no_active_timers"))
             return
 
-        stopped_count = 0
         timer_ids_to_stop = list(self.timers.keys()) # Iterate over a copy to avoid RuntimeError on dict change
 
-        for form_id in timer_ids_to_stop:
+        async def stop_one(form_id):
             timer_data = self.timers.get(form_id)
-            if timer_data:
-                # Cancel task
-                if timer_data['task']:
-                    timer_data['task'].cancel()
-                
-                # Delete message
-                try:
-                    if hasattr(timer_data['form_obj'], 'delete'):
-                        await timer_data['form_obj'].delete()
-                    else:
-                        await self.client.delete_messages(timer_data['chat_id'], [form_id])
-                except FloodWaitError as e:
-                    await asyncio.sleep(e.seconds)
-                    if hasattr(timer_data['form_obj'], 'delete'):
-                        await timer_data['form_obj'].delete()
-                    else:
-                        await self.client.delete_messages(timer_data['chat_id'], [form_id])
-                except Exception as e:
-                    print(f"Failed to delete timer message {form_id} during stoptimer: {e}")
-                
-                # Remove from tracking
-                if form_id in self.timers: # Ensure it's still there before deleting
-                    del self.timers[form_id]
-                stopped_count += 1
+            if not timer_data:
+                return 0
+            # Remove from scheduler
+            self._unschedule(form_id)
+
+            # Delete message
+            try:
+                await self._delete_timer_message(form_id, timer_data)
+            except Exception as e:
+                logger.warning("Failed to delete timer message form_id=%s during stoptimer: %s", form_id, e)
+
+            # Remove from tracking
+            if form_id in self.timers: # Ensure it's still there before deleting
+                del self.timers[form_id]
+            self._persist(form_id)
+            return 1
+
+        # Удаления в разных чатах идут параллельно, лимитер разводит их по вёдрам
+        stopped_count = sum(await asyncio.gather(*(stop_one(form_id) for form_id in timer_ids_to_stop)))
         
-        await self._save_timers() # Persist the empty/reduced state
+        self._store.flush() # Persist the empty/reduced state
         await utils.answer(message, self.strings("all_timers_stopped").format(stopped_count))
         
         # Удаляем исходную команду
         try:
-            await message.delete()
+            await self._limiter.run(message.chat_id, message.delete)
         except Exception:
-            pass # Игнорируем
\ No newline at end of file
+            pass # Игнорируем
+
+    @loader.command()
+    async def timerstats(self, message: Message):
+        """Показывает метрики таймеров. .timerstats reset — обнулить."""
+        if utils.get_args_raw(message).strip().lower() == "reset":
+            self._metrics.reset()
+            await utils.answer(message, self.strings("timerstats_reset"))
+            return
+
+        metrics = self._metrics
+        uptime = max(1e-9, time.monotonic() - metrics.started)
+        paused = sum(1 for data in self.timers.values() if data.is_paused)
+
+        lines = []
+        for name, histogram in metrics.histograms.items():
+            if not histogram.count:
+                lines.append(self.strings("timerstats_no_data").format(name=name))
+                continue
+            lines.append(self.strings("timerstats_histogram").format(
+                name=name,
+                p50=round(histogram.percentile(50) * 1000),
+                p90=round(histogram.percentile(90) * 1000),
+                p99=round(histogram.percentile(99) * 1000),
+                max=round(histogram.max * 1000),
+                count=histogram.count,
+            ))
+
+        await utils.answer(message, self.strings("timerstats").format(
+            uptime=_format_seconds_to_hms(int(uptime)),
+            active=len(self.timers) - paused,
+            paused=paused,
+            rate=metrics.counters["renders"] / uptime,
+            histograms="\n".join(lines),
+            **metrics.counters,
+        ))
+
+    async def _bench_run(self, count: int, seconds: float) -> dict:
+        """
+        Прогон count синтетических таймеров на отдельном экземпляре модуля: свой планировщик,
+        БД в памяти и лимитер без ограничений, чтобы мерить именно планировщик.
+        Длительности случайны в [seconds/2, seconds], поэтому таймеры сдвинуты по фазе.
+        """
+        bench = TimerMod()
+        bench.config = self.config
+        bench._limiter = RateLimiter(lambda: 1e6, lambda: 1e6, bench._metrics)
+        bench._store = TimerStore(_MemoryDB(), lambda: 3600)
+        bench._wakeup = asyncio.Event()
+        bench._scheduler_task = asyncio.ensure_future(bench._scheduler_loop())
+        forms = []
+        started = asyncio.get_event_loop().time()
+        try:
+            for i in range(count):
+                form = _BenchForm(-(i + 1), self.BENCH_EDIT_DELAY)
+                timer_data = TimerState("bench", random.uniform(seconds / 2, seconds), form.id, form)
+                bench.timers[form.id] = timer_data
+                forms.append((form, timer_data.deadline, timer_data.total_duration))
+                bench._schedule(form.id, 0)
+            # Запас на последний тик и удаление
+            await asyncio.sleep(seconds + 1 + self.BENCH_EDIT_DELAY[1])
+        finally:
+            await bench.on_unload()
+        elapsed = asyncio.get_event_loop().time() - started
+
+        lateness = sorted(form.deleted_at - deadline for form, deadline, _ in forms if form.deleted_at is not None)
+        histogram = Histogram(window=max(1, len(lateness)))
+        for value in lateness:
+            histogram.observe(max(0.0, value))
+        counters = bench._metrics.counters
+        return {
+            "count": count,
+            "wakeup_rate": counters["wakeups"] / elapsed,
+            "tick_rate": counters["ticks"] / sum(duration for _, _, duration in forms),
+            "renders": counters["renders"],
+            "dedup_hits": counters["dedup_hits"],
+            "expired": len(lateness),
+            "p50": round(histogram.percentile(50) * 1000),
+            "p99": round(histogram.percentile(99) * 1000),
+            "max": round(histogram.max * 1000),
+        }
+
+    @loader.command()
+    async def timerbench(self, message: Message):
+        """Бенчмарк планировщика на синтетических таймерах. .timerbench [число таймеров ...]"""
+        args = utils.get_args_raw(message).split()
+        counts = [int(arg) for arg in args if arg.isdigit()] if args else list(self.BENCH_DEFAULT_TIMERS)
+        if (
+            len(counts) != len(args or counts)
+            or not 1 <= len(counts) <= self.BENCH_MAX_RUNS
+            or not all(1 <= count <= self.BENCH_MAX_TIMERS for count in counts)
+        ):
+            await utils.answer(
+                message, self.strings("timerbench_bad_args").format(self.BENCH_MAX_RUNS, self.BENCH_MAX_TIMERS)
+            )
+            return
+
+        message = await utils.answer(message, self.strings("timerbench_running").format(
+            counts=", ".join(map(str, counts)),
+            seconds=len(counts) * (self.BENCH_SECONDS + 1),
+        ))
+        # Прогоны идут по очереди, чтобы не делить между собой CPU и event loop
+        rows = []
+        for count in counts:
+            rows.append(self.strings("timerbench_row").format(**await self._bench_run(count, self.BENCH_SECONDS)))
+        await utils.answer(message, self.strings("timerbench_result").format(
+            seconds=self.BENCH_SECONDS,
+            min_seconds=self.BENCH_SECONDS // 2,
+            edit_min=self.BENCH_EDIT_DELAY[0],
+            edit_max=self.BENCH_EDIT_DELAY[1],
+            rows="\n\n".join(rows),
+        ))